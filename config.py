@@ -24,6 +24,91 @@ listen_game_port = int(listen_login_port) - 1
 announce_host = listen_login_host
 announce_port = listen_game_port
 
+# The number of worker processes doing the RSA work of the login and game
+# handshakes. With 0, it is done on the connection's own thread, which stalls
+# the other sessions while a wave of new logins is being handled.
+handshake_workers = 0
+
+# Whether to verify the checksums of the relayed game frames. Frames with a
+# bad checksum are dropped instead of being forwarded.
+verify_checksums = True
+
+# How the connections are handled: 'threads' runs a thread per connection,
+# 'asyncio' runs all of them as coroutines on a single event loop and
+# 'reactor' drives all of them from a single thread with epoll (or whatever
+# the selectors module picks), both of which scale to many more concurrent
+# sessions.
+engine = 'threads'
+
+# The number of worker processes, all listening on the same ports (this needs
+# SO_REUSEPORT, e.g. Linux 3.9+). Each of them has its own GIL, so the
+# throughput scales with the number of cores. With 0, everything runs in the
+# main process.
+workers = 0
+
+# How long (in seconds) the proxy remembers which game server a character
+# logged in to, and how many characters it remembers at most; the least
+# recently used ones are forgotten first.
+route_ttl = 3600
+route_capacity = 10000
+
+# Where those routes are kept. None keeps them in the proxy (in shared memory
+# if there are workers). A file path keeps them in a memory-mapped file that
+# other proxies on the same machine can use as well. 'host:port' uses a route
+# store shared by several machines, started with:
+# TIBIAPROXY_ROUTE_SECRET=... python -m tibiaproxy.RoutingTable host:port
+# Whoever can store routes there decides which server the players log in to,
+# credentials included. The store listens on 127.0.0.1 when given just a
+# port, and refuses to listen elsewhere without a secret; route_store_secret
+# has to match it. The secret is sent in the clear, so keep the store on a
+# trusted network too.
+route_store = None
+route_store_secret = None
+
+# Admission control. The backlog of the listening sockets; then, for the
+# threaded engine, the number of threads doing the login and game handshakes
+# and the number of threads relaying game sessions (the most sessions at
+# once), and how many connections may wait for either kind of thread, and for
+# how many seconds, before they are turned away. A client that does not get
+# through its handshake within handshake_timeout seconds is disconnected, so
+# that stalled clients cannot hold up the handshake threads.
+listen_backlog = 128
+handshake_threads = 16
+relay_threads = 1000
+max_queued = 256
+max_queue_wait = 5.0
+handshake_timeout = 10.0
+
+# The login servers the logins are spread between, as (host, port) or
+# (host, port, weight) tuples; None means just destination_login_host and
+# destination_login_port. Each login goes to the healthy server with the
+# fewest logins in progress for its weight. Every upstream_probe_interval
+# seconds (0 disables this), each server gets a probe connection; one that
+# refuses it, or fails upstream_max_failures logins in a row, is left out
+# until a probe gets through. A server that does not accept the connection,
+# or does not reply, within upstream_timeout seconds is given up on and the
+# login is retried on the next one.
+login_upstreams = None
+upstream_probe_interval = 5.0
+upstream_timeout = 3.0
+upstream_max_failures = 2
+
+# The number of connections to each login server kept open in advance, so
+# that a login does not wait for one to be established (0 disables this), and
+# how many seconds an unused one is kept before it is replaced, since the
+# login server drops the clients that stay silent for too long.
+login_pool_size = 0
+login_pool_idle = 10.0
+
+# How the plugin hooks run. With 0 plugin threads, they run in the relay, so a
+# slow hook holds up its whole session. Otherwise they run on that many
+# threads: a frame with packets for the plugins is held back until its hooks
+# are done, then forwarded or dropped as they decided, while the other frames
+# keep flowing. Hooks that take more than plugin_timeout seconds are given up
+# on and their frame is forwarded.
+plugin_threads = 0
+plugin_timeout = 3.0
+
 # Whether we're in the debug mode or not. This gives you additional debug
 # messages and drops you into a debugger if an uncaught exception happens.
 debug = True
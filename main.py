@@ -24,6 +24,9 @@ import importlib
 import os
 
 from tibiaproxy.Server import Server
+from tibiaproxy.Supervisor import Supervisor
+from tibiaproxy.RoutingTable import openRoutingTable
+from tibiaproxy.UpstreamGroup import openUpstreamGroup
 from tibiaproxy.util import log
 
 
@@ -41,18 +44,49 @@ def tibiaproxy_main(config):
         plugins += [importlib.import_module('plugins.' + plugin_name)]
         log("Loaded plugin %s." % plugin_name)
 
-    server = Server(destination_login_host=config['destination_login_host'],
-                    destination_login_port=config['destination_login_port'],
-                    listen_login_host=config['listen_login_host'],
-                    listen_login_port=config['listen_login_port'],
-                    listen_game_host=config['listen_game_host'],
-                    listen_game_port=config['listen_game_port'],
-                    announce_host=config['announce_host'],
-                    announce_port=config['announce_port'],
-                    real_tibia=config['real_tibia'],
-                    debug=config['debug'],
-                    plugins=plugins)
-    server.run()
+    if config['engine'] == 'asyncio':
+        from tibiaproxy.AsyncServer import AsyncServer as server_class
+    elif config['engine'] == 'reactor':
+        from tibiaproxy.ReactorServer import ReactorServer as server_class
+    else:
+        server_class = Server
+
+    server_args = dict(
+        destination_login_host=config['destination_login_host'],
+        destination_login_port=config['destination_login_port'],
+        listen_login_host=config['listen_login_host'],
+        listen_login_port=config['listen_login_port'],
+        listen_game_host=config['listen_game_host'],
+        listen_game_port=config['listen_game_port'],
+        announce_host=config['announce_host'],
+        announce_port=config['announce_port'],
+        real_tibia=config['real_tibia'],
+        debug=config['debug'],
+        plugins=plugins,
+        handshake_workers=config['handshake_workers'],
+        verify_checksums=config['verify_checksums'],
+        listen_backlog=config['listen_backlog'],
+        handshake_threads=config['handshake_threads'],
+        handshake_timeout=config['handshake_timeout'],
+        relay_threads=config['relay_threads'],
+        max_queued=config['max_queued'],
+        max_queue_wait=config['max_queue_wait'],
+        plugin_threads=config['plugin_threads'],
+        plugin_timeout=config['plugin_timeout'],
+        upstreams=openUpstreamGroup(
+            config['login_upstreams'] or [(config['destination_login_host'],
+                                           config['destination_login_port'])],
+            config['upstream_probe_interval'], config['upstream_timeout'],
+            config['upstream_max_failures'], config['login_pool_size'],
+            config['login_pool_idle']),
+        routes=openRoutingTable(config['route_store'], config['route_ttl'],
+                                config['route_capacity'],
+                                shared=config['workers'] > 0,
+                                secret=config['route_store_secret']))
+    if config['workers'] > 0:
+        Supervisor(server_class, server_args, config['workers']).run()
+    else:
+        server_class(**server_args).run()
 
 
 def run_pdb_hook(*args, **kwargs):
@@ -2,19 +2,22 @@
 
 Whenever the user says anything that begins with >, it gets executed as
 a line of Python code, with the result being sent back to the player.
+The code runs in a separate, confined process with limited CPU time and
+memory (see tibiaproxy.Sandbox), so that it cannot hang or crash the proxy.
+That takes a while, so with plugin_threads = 0 the session's relay waits
+for it; with plugin threads, only the message does.
 
 The original message does not get forwarded to the server.
 """
 
+from tibiaproxy import Sandbox
+
 
 def on_client_say(conn, msg):
     """If the message started with >, run it as a Python code."""
     if not msg.startswith(">"):
         return False
-    try:
-        to_send = str(eval(msg[1:].lstrip()))
-    except Exception as e:
-        to_send = str(e)
+    to_send = Sandbox.evaluate(msg[1:].lstrip())
     conn.client_send_said(player={'name': '1', 'level': 1},
                           pos=[96, 123, 7],
                           msg=to_send)
@@ -3,17 +3,21 @@
 """
 Usage:
 
-./run_tests.py
+./run_tests.py [threads|reactor|asyncio]
 
-Runs the tibiaproxy in debug mode, connects to it and simulates the Tibia
-server.
+Runs the tibiaproxy in debug mode with the given engine (threads by default),
+connects to it and simulates the Tibia server. Fails unless the game
+connection makes it through to the game server.
 """
 
 import main
 import socket
+import sys
 import threading
 import time
 
+engine = sys.argv[1] if len(sys.argv) > 1 else 'threads'
+
 l_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 l_s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 l_s.bind(("127.0.0.1", 7172))
@@ -33,6 +37,7 @@ def reply_with_charlist(l_s):
 def reply_with_game(g_s):
     g_s.listen(1)
     s, _ = g_s.accept()
+    game_reached.set()
     s.send(open("test/game-response.bin", "rb").read())
     s.close()
 
@@ -56,20 +61,57 @@ def request_game():
     time.sleep(0.2)
     s.close()
 
-threading.Thread(target=reply_with_charlist, args=(l_s,)).start()
-threading.Thread(target=reply_with_game, args=(g_s,)).start()
-threading.Timer(0.1, request_charlist).start()
-threading.Timer(0.2, request_game).start()
+game_reached = threading.Event()
+for t in [threading.Thread(target=reply_with_charlist, args=(l_s,)),
+          threading.Thread(target=reply_with_game, args=(g_s,)),
+          threading.Timer(0.1, request_charlist),
+          threading.Timer(0.2, request_game)]:
+    t.daemon = True
+    t.start()
 
-main.tibiaproxy_main({
+config = {
     'announce_host': '127.0.0.1',
     'announce_port': 7170,
     'debug': True,
+    'handshake_threads': 16,
+    'handshake_timeout': 10.0,
+    'handshake_workers': 0,
+    'engine': engine,
     'destination_login_host': '127.0.0.1',
     'destination_login_port': '7172',
     'listen_game_host': '127.0.0.1',
     'listen_game_port': 7170,
     'listen_login_host': '127.0.0.1',
+    'listen_backlog': 128,
     'listen_login_port': '7171',
-    'real_tibia': False
-})
+    'login_pool_idle': 10.0,
+    'login_pool_size': 0,
+    'login_upstreams': None,
+    'max_queue_wait': 5.0,
+    'max_queued': 256,
+    'plugin_threads': 0,
+    'plugin_timeout': 3.0,
+    'real_tibia': False,
+    'relay_threads': 1000,
+    'route_capacity': 10000,
+    'route_store': None,
+    'route_store_secret': None,
+    'route_ttl': 3600,
+    'upstream_max_failures': 2,
+    'upstream_probe_interval': 5.0,
+    'upstream_timeout': 3.0,
+    'verify_checksums': True,
+    'workers': 0
+}
+if engine == 'threads':
+    # Handles one login and one game connection, then returns.
+    main.tibiaproxy_main(config)
+else:
+    # The other engines serve forever.
+    proxy = threading.Thread(target=main.tibiaproxy_main, args=(config,))
+    proxy.daemon = True
+    proxy.start()
+    time.sleep(1)
+
+if not game_reached.wait(5):
+    sys.exit("The game connection did not reach the game server")
@@ -0,0 +1,348 @@
+"""
+AsyncServer.py - runs the proxy on a single asyncio event loop instead of a
+thread per connection.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import asyncio
+import struct
+import time
+
+from tibiaproxy.NetworkMessage import NetworkMessage
+from tibiaproxy.Server import Server, BOGUS_CHALLENGE
+from tibiaproxy import GameProtocol
+from tibiaproxy.util import log
+
+_U16 = struct.Struct("<H")
+
+
+class StreamConnection(object):
+    """Gives a StreamWriter the send method that Connection expects, so that
+    the plugins can inject packets just like with the threaded server."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def send(self, data):
+        if self.writer.is_closing():
+            # The session ended while a plugin hook was running.
+            return 0
+        self.writer.write(data)
+        return len(data)
+
+
+async def read_frame(reader):
+    """Reads a whole length-prefixed frame.
+
+    Args:
+        reader (StreamReader): the stream to read from
+
+    Returns bytes (the frame, size header included) or None if the peer
+        disconnected
+    """
+    try:
+        header = await reader.readexactly(2)
+        return header + await reader.readexactly(_U16.unpack(header)[0])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+def close(writer):
+    """Closes a stream, ignoring the errors of an already broken one.
+
+    Returns None
+    """
+    try:
+        writer.close()
+    except (OSError, RuntimeError):
+        pass
+
+
+def discard(preconnect):
+    """Throws away a speculative open_connection, whether it is still in
+    progress or not.
+
+    Returns None
+    """
+    def closeConnection(future):
+        if not future.cancelled() and future.exception() is None:
+            close(future.result()[1])
+    preconnect.add_done_callback(closeConnection)
+    preconnect.cancel()
+
+
+class AsyncServer(Server):
+    """A Server that runs the login handshake, the game handshake and the
+    relay of every session as coroutines on one event loop. The RSA work,
+    being CPU-bound, is handed to the default executor (and from there to the
+    handshake workers, if configured) so that it does not stall the loop."""
+
+    def run(self):
+        """Run the login and game servers on a new event loop, forever.
+
+        Returns None
+        """
+        log(("Listening on address %s:%s (login), %s:%s (game), connections " +
+             "will be forwarded to %s:%s (asyncio)") % (
+                 self.listen_login_host, self.listen_login_port,
+                 self.listen_game_host, self.listen_game_port,
+                 self.destination_login_host, self.destination_login_port))
+        self.upstreams.start()
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.serve())
+        except (KeyboardInterrupt, SystemExit):
+            log("Received keyboard interrupt, quitting")
+        finally:
+            loop.close()
+
+    async def serve(self):
+        """Accepts the login and game connections on l_s and g_s.
+
+        Returns None
+        """
+        self.l_s.listen(self.listen_backlog)
+        self.g_s.listen(self.listen_backlog)
+        login_server = await asyncio.start_server(self.handleLoginStream,
+                                                  sock=self.l_s)
+        game_server = await asyncio.start_server(self.handleGameStream,
+                                                 sock=self.g_s)
+        await asyncio.gather(login_server.serve_forever(),
+                             game_server.serve_forever())
+
+    async def offload(self, func, *args):
+        """Runs a blocking function in the default executor.
+
+        Returns whatever func returns
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def consultRoutes(self, func, *args):
+        """Runs a function that consults the routing table; in the default
+        executor if the routes are kept remotely, so that a slow route store
+        does not stall the loop.
+
+        Returns whatever func returns
+        """
+        if self.routes.isRemote():
+            return await self.offload(func, *args)
+        return func(*args)
+
+    def connectUpstream(self, upstream):
+        """Starts connecting to a login server, or takes one of the pooled
+        connections to it.
+
+        Returns Future (of the StreamReader and StreamWriter)
+        """
+        sock = upstream.take()
+        if sock is not None:
+            sock.setblocking(False)
+            return asyncio.ensure_future(asyncio.open_connection(sock=sock))
+        log("Connecting to the login server %s..." % upstream)
+        return asyncio.ensure_future(
+            asyncio.open_connection(*upstream.address))
+
+    async def exchangeLogin(self, upstream, connecting, request):
+        """The coroutine version of UpstreamRequest.exchange.
+
+        Args:
+            upstream (Upstream): the login server
+            connecting (Future): the connection to it, from connectUpstream
+            request (bytearray): the login request
+
+        Returns bytes or None if the login server failed
+        """
+        timeout = self.upstreams.timeout
+        dest_writer = None
+        try:
+            dest_reader, dest_writer = await asyncio.wait_for(connecting,
+                                                              timeout)
+            dest_writer.write(request)
+            data = await asyncio.wait_for(read_frame(dest_reader), timeout)
+            if data is None:
+                log("Login server %s disconnected." % upstream)
+            return data
+        except (OSError, asyncio.TimeoutError) as e:
+            log("Login server %s failed: %r" % (upstream, e))
+            return None
+        finally:
+            if dest_writer is not None:
+                close(dest_writer)
+
+    async def handleLoginStream(self, reader, writer):
+        """The coroutine version of Server.handleLogin.
+
+        Args:
+            reader (StreamReader): the player's connection
+            writer (StreamWriter): the player's connection
+
+        Returns None
+        """
+        peer = writer.get_extra_info('peername')
+        log("Received a login connection from %s:%s" % peer[:2])
+        group = self.upstreams
+        upstream = None
+        try:
+            # A client that stalls only holds the handshake for so long.
+            data = await asyncio.wait_for(read_frame(reader),
+                                          self.handshake_timeout)
+            if data is None:
+                return
+            # The connection is set up while the request is decrypted.
+            upstream = group.acquire()
+            tried = [upstream]
+            started = time.time()
+            connecting = self.connectUpstream(upstream)
+            try:
+                xtea_key, request = await self.offload(
+                    self.rewriteLoginRequest, NetworkMessage(data))
+            except Exception:
+                discard(connecting)
+                raise
+            data = await self.exchangeLogin(upstream, connecting, request)
+            # Fail over to the other login servers if need be.
+            while data is None:
+                group.release(upstream, False)
+                upstream = group.acquire(tried)
+                if upstream is None:
+                    log("None of the login servers replied.")
+                    return
+                tried += [upstream]
+                started = time.time()
+                data = await self.exchangeLogin(
+                    upstream, self.connectUpstream(upstream), request)
+            group.release(upstream, True, time.time() - started)
+            upstream = None
+            writer.write(await self.consultRoutes(
+                self.rewriteLoginReply, data, xtea_key, peer[0]))
+            await writer.drain()
+        except asyncio.TimeoutError:
+            log("The login handshake timed out")
+        except ConnectionError as e:
+            log("Login connection failed: %s" % e)
+        finally:
+            close(writer)
+            if upstream is not None:
+                group.release(upstream)
+
+    async def handleGameStream(self, reader, writer):
+        """The coroutine version of Server.handleGame.
+
+        Args:
+            reader (StreamReader): the player's connection
+            writer (StreamWriter): the player's connection
+
+        Returns None
+        """
+        peer = writer.get_extra_info('peername')
+        log("Received a game server connection from %s:%s" % peer[:2])
+        dest_writer = None
+        # If this address just logged in, connect to the game server it most
+        # likely enters while the client is still answering the challenge.
+        guess = await self.consultRoutes(self.routes.lookupPeer, peer[0])
+        preconnect = None
+        if guess is not None:
+            preconnect = asyncio.ensure_future(asyncio.open_connection(*guess))
+        try:
+            writer.write(BOGUS_CHALLENGE)
+            # A client or game server that stalls only holds the handshake
+            # for so long.
+            data = await asyncio.wait_for(read_frame(reader),
+                                          self.handshake_timeout)
+            if data is None:
+                return
+            firstmsg_contents = await self.offload(
+                GameProtocol.parseFirstMessage, NetworkMessage(data),
+                self.handshake)
+
+            address = await self.consultRoutes(self.gameServerAddress,
+                                               firstmsg_contents)
+            if address is None:
+                return
+            if preconnect is not None and address == guess:
+                try:
+                    dest_reader, dest_writer = await preconnect
+                    log("Using the connection to the game server (%s:%s) "
+                        "opened in advance." % address)
+                except OSError:
+                    pass
+                preconnect = None
+            if dest_writer is None:
+                log("Connecting to the game server (%s:%s)." % address)
+                dest_reader, dest_writer = await asyncio.wait_for(
+                    asyncio.open_connection(*address),
+                    self.handshake_timeout)
+            data = await asyncio.wait_for(read_frame(dest_reader),
+                                          self.handshake_timeout)
+            if data is None:
+                log("The server disconnected")
+                return
+            # Skip the size and the checksum.
+            dest_writer.write(await self.offload(
+                self.answerChallenge, firstmsg_contents,
+                NetworkMessage(data[6:])))
+
+            loop = asyncio.get_event_loop()
+            session = self.newSession(StreamConnection(writer),
+                                      firstmsg_contents,
+                                      StreamConnection(dest_writer),
+                                      loop.call_soon_threadsafe)
+            relays = [asyncio.ensure_future(self.relay(
+                          session, "C", reader, dest_writer)),
+                      asyncio.ensure_future(self.relay(
+                          session, "S", dest_reader, writer))]
+            # Once either side is gone, so is the session.
+            _, pending = await asyncio.wait(
+                relays, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+        except asyncio.TimeoutError:
+            log("The game handshake timed out")
+        except ConnectionError as e:
+            log("Game connection failed: %s" % e)
+        finally:
+            if preconnect is not None:
+                discard(preconnect)
+            close(writer)
+            if dest_writer is not None:
+                close(dest_writer)
+
+    async def relay(self, session, direction, reader, writer):
+        """Relays the frames of one direction of a game session.
+
+        Args:
+            session (dict): as returned by newSession
+            direction (str): "C" for the client's frames, "S" for the
+                server's
+            reader (StreamReader): where the frames come from
+            writer (StreamWriter): where they are forwarded to
+
+        Returns None
+        """
+        while True:
+            data = await read_frame(reader)
+            if data is None:
+                log("The %s disconnected" % (
+                    "client" if direction == "C" else "server"))
+                return
+            if self.filterFrame(session, direction, data):
+                writer.write(data)
+            # The packets the plugins injected go right behind the frame.
+            session['connection'].flush()
+            await writer.drain()
@@ -0,0 +1,158 @@
+"""
+ConnectionScheduler.py - runs the connections of the threaded server on a
+bounded number of threads and turns connections away when it is overloaded.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import threading
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from tibiaproxy.util import log
+
+
+class WorkerPool(object):
+    """Up to a fixed number of threads taking jobs from a bounded queue. The
+    threads are started as the jobs come in, once there are more jobs queued
+    than idle threads. A job that does not fit in the queue, or that waited
+    in it for too long, is rejected instead of being run.
+
+    >>> pool = WorkerPool("test", threads=0, max_queued=1, max_wait=10)
+    >>> rejected = []
+    >>> pool.submit(log, ["run"], lambda: rejected.append(1))
+    True
+    >>> pool.submit(log, ["run"], lambda: rejected.append(2))
+    False
+    >>> rejected, pool.depth()
+    ([2], 1)
+    """
+
+    def __init__(self, name, threads, max_queued, max_wait):
+        """Create a WorkerPool instance. None of its threads is started yet.
+
+        Args:
+            name (str): used in the log messages
+            threads (int): the most threads
+            max_queued (int): the most jobs waiting for a thread
+            max_wait (float): the longest a job may wait for a thread, in
+                seconds
+        """
+        self.name = name
+        self.max_wait = max_wait
+        self.jobs = queue.Queue(max_queued)
+        self.threads = threads
+        self.started = 0
+        # The threads waiting for a job.
+        self.idle = 0
+        self.lock = threading.Lock()
+
+    def submit(self, func, args, reject):
+        """Queues func(*args) for a thread. If the queue is full, reject() is
+        called right away; if the job waits for too long, it is called
+        instead of func.
+
+        Returns bool (False if the job was rejected right away)
+        """
+        try:
+            self.jobs.put_nowait((time.time(), func, args, reject))
+        except queue.Full:
+            log("The %s queue is full" % self.name)
+            if reject is not None:
+                reject()
+            return False
+        with self.lock:
+            if self.started >= self.threads or \
+                    self.jobs.qsize() <= self.idle:
+                return True
+            self.started += 1
+        t = threading.Thread(target=self.work)
+        t.daemon = True
+        t.start()
+        return True
+
+    def depth(self):
+        """Returns int (the number of jobs waiting for a thread)"""
+        return self.jobs.qsize()
+
+    def work(self):
+        """The body of the pool's threads.
+
+        Returns None
+        """
+        while True:
+            with self.lock:
+                self.idle += 1
+            queued, func, args, reject = self.jobs.get()
+            with self.lock:
+                self.idle -= 1
+            try:
+                if time.time() - queued > self.max_wait:
+                    log("A job waited too long in the %s queue" % self.name)
+                    if reject is not None:
+                        reject()
+                else:
+                    func(*args)
+            except Exception:
+                log(traceback.format_exc())
+
+
+class ConnectionScheduler(object):
+    """Admission control of the threaded server. Handshakes (the login
+    exchange and the game handshake) are short and run on one pool; relaying
+    a game session takes a thread for as long as the session lasts and runs
+    on another, so that a burst of new connections waits for its turn
+    instead of starving the sessions that are already relaying."""
+
+    def __init__(self, handshake_threads, relay_threads, max_queued,
+                 max_wait):
+        """Create a ConnectionScheduler instance.
+
+        Args:
+            handshake_threads (int): the number of handshake threads
+            relay_threads (int): the number of relay threads, i.e. the most
+                game sessions relayed at once
+            max_queued (int): the most connections waiting for each pool
+            max_wait (float): the longest a connection may wait, in seconds
+        """
+        self.handshakes = WorkerPool("handshake", handshake_threads,
+                                     max_queued, max_wait)
+        self.relays = WorkerPool("relay", relay_threads, max_queued,
+                                 max_wait)
+
+    def handshake(self, func, args, reject):
+        """Schedules a handshake. See WorkerPool.submit.
+
+        Returns bool
+        """
+        return self.handshakes.submit(func, args, reject)
+
+    def relay(self, func, args, reject):
+        """Schedules the relay of a game session. See WorkerPool.submit.
+
+        Returns bool
+        """
+        return self.relays.submit(func, args, reject)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,169 @@
+"""
+FrameCodec.py - turns XTEA-encrypted game protocol frames into messages and
+back in a single pass.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import struct
+import zlib
+
+from tibiaproxy import XTEA
+
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_HEADER = struct.Struct("<HI")
+
+# A frame starts with its size (U16) and the checksum (U32) of the
+# encrypted part, which in turn starts with the size (U16) of the message.
+HEADER_SIZE = 6
+
+_PADDING = b'\x33' * 8
+
+
+def adler32(buf):
+    """Calculates the Adler checksum of the given buffer, in C.
+
+    >>> adler32(b'Wikipedia')
+    300286872
+
+    Args:
+        buf (bytearray): the buffer (or memoryview) to be checksummed
+
+    Returns int
+    """
+    return zlib.adler32(buf) & 0xFFFFFFFF
+
+
+class FrameCodec(object):
+    """Decodes and encodes the frames of one direction of a game session.
+
+    >>> codec = FrameCodec([1, 2, 3, 4])
+    >>> frame = codec.encode(b'hello')
+    >>> len(frame)
+    14
+    >>> codec.decode(frame).tobytes() == b'hello'
+    True
+    >>> frame[-1] ^= 1
+    >>> codec.decode(frame) is None
+    True
+    """
+
+    def __init__(self, cipher, verify_checksum=True):
+        """Create a FrameCodec instance.
+
+        Args:
+            cipher (XTEACipher or list): the session's XTEA cipher, or the raw
+                XTEA key
+            verify_checksum (bool): whether decode() should check the Adler
+                checksum of the frames
+        """
+        if not isinstance(cipher, XTEA.XTEACipher):
+            cipher = XTEA.XTEACipher(cipher)
+        self.cipher = cipher
+        self.verify_checksum = verify_checksum
+        self.plain = bytearray()
+
+    def decode(self, frame):
+        """Verifies the checksum of a frame, decrypts it and strips the
+        message size. The frame itself is left intact so that it can still be
+        forwarded as it is.
+
+        Args:
+            frame (bytearray): the whole frame, size header included
+
+        Returns memoryview (the message, only valid until the next decode
+            call) or None if the frame is malformed or corrupt
+        """
+        view = memoryview(frame)
+        body_size = len(view) - HEADER_SIZE
+        if body_size < 8 or body_size % 8 != 0:
+            return None
+        size, checksum = _HEADER.unpack_from(view, 0)
+        if size != len(view) - 2:
+            return None
+        body = view[HEADER_SIZE:]
+        if self.verify_checksum and checksum != adler32(body):
+            return None
+        if len(self.plain) < body_size:
+            self.plain = bytearray(2 * body_size)
+        self.cipher.decrypt_into(body, self.plain)
+        msg_size = _U16.unpack_from(self.plain, 0)[0]
+        if msg_size > body_size - 2:
+            return None
+        return memoryview(self.plain)[2:2+msg_size]
+
+    def encode(self, msg):
+        """Pads the message, prefixes it with its size, encrypts it and adds
+        the checksum and frame size, all in one buffer.
+
+        Args:
+            msg (bytearray): the message to be sent
+
+        Returns bytearray
+        """
+        msg_size = len(msg)
+        frame = bytearray(HEADER_SIZE + padded_size(msg_size))
+        start = HEADER_SIZE + 2
+        frame[start:start+msg_size] = msg
+        self.encode_into(frame, start, msg_size)
+        return frame
+
+    def encode_into(self, buf, start, msg_size):
+        """Turns a message that already sits in buf into a frame, in place.
+        The HEADER_SIZE + 2 bytes before the message must be free for the
+        headers and there must be room for the padding after it.
+
+        Args:
+            buf (bytearray): the buffer holding the message
+            start (int): where the message begins
+            msg_size (int): the size of the message
+
+        Returns memoryview (the frame)
+        """
+        body_start = start - 2
+        body_size = padded_size(msg_size)
+        frame_start = body_start - HEADER_SIZE
+        frame_end = body_start + body_size
+        end = start + msg_size
+        buf[end:frame_end] = _PADDING[:frame_end-end]
+        _U16.pack_into(buf, body_start, msg_size)
+        self.cipher.encrypt_inplace(buf, body_start, body_size)
+        checksum = adler32(memoryview(buf)[body_start:frame_end])
+        _HEADER.pack_into(buf, frame_start, 4 + body_size, checksum)
+        return memoryview(buf)[frame_start:frame_end]
+
+
+def padded_size(msg_size):
+    """Returns the size of the encrypted part of a frame carrying a message of
+    the given size: the message and its size header, padded to full XTEA
+    blocks.
+
+    >>> padded_size(5), padded_size(6), padded_size(7)
+    (8, 8, 16)
+
+    Args:
+        msg_size (int): the size of the message
+
+    Returns int
+    """
+    body_size = msg_size + 2
+    return body_size + (8 - body_size % 8) % 8
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,167 @@
+"""
+FrameReader.py - splits the byte stream of a socket into length-prefixed
+frames, no matter how the frames are cut up or glued together by TCP.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import struct
+
+_U16 = struct.Struct("<H")
+
+
+class FrameReader(object):
+    """Reads a socket with recv_into into one reusable buffer and cuts every
+    complete frame out of it. A partial frame stays in the buffer until the
+    rest of it arrives; it is moved to the front of the buffer once the free
+    space after it runs low, and the buffer only grows for frames that would
+    not fit at all.
+
+    The frames are returned as memoryviews of the buffer, so they are only
+    valid until the next read.
+
+    >>> import socket
+    >>> a, b = socket.socketpair()
+    >>> reader = FrameReader(b, capacity=8)
+    >>> _ = a.send(b'\\x01\\x00a\\x02\\x00bc\\x03\\x00d')
+    >>> [frame.tobytes() for frame in reader.readFrames()]
+    [b'\\x01\\x00a', b'\\x02\\x00bc']
+    >>> _ = a.send(b'ef\\x00\\x00')
+    >>> [frame.tobytes() for frame in reader.readFrames()]
+    [b'\\x03\\x00def', b'\\x00\\x00']
+    >>> a.close()
+    >>> reader.readFrames() is None
+    True
+    """
+
+    # The least amount of free space offered to a single recv_into call.
+    MIN_READ = 4096
+
+    def __init__(self, sock, capacity=65536):
+        """Create a FrameReader instance.
+
+        Args:
+            sock (socket): the socket to read from
+            capacity (int): the initial size of the buffer, in bytes
+        """
+        self.sock = sock
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def fill(self):
+        """Receives whatever the socket has got, with a single call. Raises
+        the socket's exceptions, e.g. BlockingIOError for a non-blocking
+        socket that has nothing to read.
+
+        Returns int (the number of bytes received; 0 if the peer disconnected)
+        """
+        self._makeRoom()
+        received = self.sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def _makeRoom(self):
+        """Makes sure the next recv_into gets a decent amount of space, by
+        moving the pending data to the front or by growing the buffer.
+
+        Returns None
+        """
+        pending = self.end - self.start
+        if pending == 0:
+            self.start = self.end = 0
+            return
+        if len(self.buf) - self.end >= self.MIN_READ:
+            return
+        needed = pending
+        if pending >= 2:
+            needed = max(needed, _U16.unpack_from(self.buf, self.start)[0] + 2)
+        if needed + self.MIN_READ > len(self.buf):
+            grown = bytearray(max(2 * len(self.buf), needed + self.MIN_READ))
+            grown[:pending] = self.view[self.start:self.end]
+            self.buf = grown
+            self.view = memoryview(grown)
+        else:
+            self.buf[:pending] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def nextFrame(self):
+        """Takes the next complete frame out of the buffer, without reading.
+
+        Returns memoryview (the frame, size header included) or None if there
+            is no complete frame buffered
+        """
+        pending = self.end - self.start
+        if pending < 2:
+            return None
+        size = _U16.unpack_from(self.buf, self.start)[0] + 2
+        if pending < size:
+            return None
+        frame = self.view[self.start:self.start+size]
+        self.start += size
+        return frame
+
+    def hasFrame(self):
+        """Returns bool (whether a complete frame is already buffered)"""
+        pending = self.end - self.start
+        return pending >= 2 and \
+            pending >= _U16.unpack_from(self.buf, self.start)[0] + 2
+
+    def takePending(self):
+        """Takes everything that is buffered, complete frames or not, for when
+        the stream is going to be relayed without framing from now on.
+
+        Returns memoryview (valid until the next read)
+        """
+        pending = self.view[self.start:self.end]
+        self.start = self.end = 0
+        return pending
+
+    def readFrames(self):
+        """Returns all of the complete frames, reading from the socket once
+        unless some are already buffered.
+
+        Returns list (of memoryviews, possibly empty) or None if the peer
+            disconnected
+        """
+        if not self.hasFrame() and self.fill() == 0:
+            return None
+        frames = []
+        frame = self.nextFrame()
+        while frame is not None:
+            frames += [frame]
+            frame = self.nextFrame()
+        return frames
+
+    def readFrame(self):
+        """Reads until a whole frame is buffered, then returns just that one;
+        the data after it stays buffered. Meant for blocking sockets.
+
+        Returns memoryview or None if the peer disconnected
+        """
+        frame = self.nextFrame()
+        while frame is None:
+            if self.fill() == 0:
+                return None
+            frame = self.nextFrame()
+        return frame
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -20,6 +20,7 @@ GameProtocol.py - contains code needed to handle the game protocol.
 
 from tibiaproxy.NetworkMessage import NetworkMessage, adlerChecksum
 from tibiaproxy import RSA
+from tibiaproxy import HandshakeService
 import struct
 
 
@@ -80,17 +81,21 @@ def parseChallengeMessage(msg):
     return create_handshake_challenge(timestamp, random_number)
 
 
-def parseFirstMessage(orig_msg):
+def parseFirstMessage(orig_msg, handshake=None):
     """Parse the first (client's) message from the game protocol.
 
     Args:
         orig_msg (NetworkMessage): the network message to be parsed.
+        handshake (HandshakeService): runs the RSA decryption; defaults to
+            doing it on the calling thread.
 
     Returns list
     """
+    handshake = handshake or HandshakeService.inline
     orig_msg.skipBytes(16)
-    msg_buf = RSA.RSA_decrypt(orig_msg.getRest()[:128])
-    msg = NetworkMessage(msg_buf)
+    msg_buf = handshake.decrypt(orig_msg.getRest()[:128])
+    msg = NetworkMessage.wrap(msg_buf)
+    assert(msg.getByte() == 0)  # RSA block padding
     # Extract the XTEA keys from the RSA-decrypted message.
     xtea_key = [msg.getU32() for _ in range(4)]
     assert(msg.getByte() == 0)        # gamemaster flag
@@ -111,15 +116,18 @@ def parseFirstMessage(orig_msg):
                                   decrypted_raw=bytearray(msg_buf))
 
 
-def prepareReply(handshake_reply, real_tibia):
+def prepareReply(handshake_reply, real_tibia, handshake=None):
     """Create a handshake reply based on the dictionary from the argument that
     has a modified challenge response.
 
     handshake_reply (dict): the origina handshake reply dictionary
     real_tibia (bool): whether to reencrypt the message for real Tibia
+    handshake (HandshakeService): runs the RSA encryption; defaults to doing
+        it on the calling thread.
 
     Returns bytearray
     """
+    handshake = handshake or HandshakeService.inline
 
     to_encrypt_raw = handshake_reply['decrypted_raw']
     to_encrypt_msg = NetworkMessage(to_encrypt_raw)
@@ -129,9 +137,9 @@ def prepareReply(handshake_reply, real_tibia):
     to_encrypt = to_encrypt_msg.getRaw()
     first16_wo_headers = handshake_reply['first_16'][6:]
     if real_tibia:
-        encrypted = RSA.RSA_encrypt(to_encrypt)
+        encrypted = handshake.encrypt(to_encrypt)
     else:
-        encrypted = RSA.RSA_encrypt(to_encrypt, n=RSA.otserv_n)
+        encrypted = handshake.encrypt(to_encrypt, n=RSA.otserv_n)
     rest = first16_wo_headers + encrypted
     checksum = struct.pack("<I", adlerChecksum(rest))
     return (handshake_reply['first_16'][:2] + checksum + rest)
@@ -329,3 +337,342 @@ server_packet_types = {
     0xF8: 'MarketDetail',
     0xF9: 'MarketBrowse',
 }
+
+# Layouts of the packets, following the opcode byte. Each field is a
+# (name, type) pair, where type is one of 'byte', 'u16', 'u32', 'string' and
+# 'coordinates' (read as an [x, y, z] list). Only packets with a fixed layout
+# are described; the parsing of a frame stops at the first packet that does
+# not have a schema, since there is no way to tell where it ends. A byte
+# field may come with a third element, the values the layout holds for; for
+# any other value, the packet is treated as one without a schema.
+# SPEAK_SAY, SPEAK_WHISPER and SPEAK_YELL.
+PUBLIC_SPEAK_TYPES = (1, 2, 3)
+
+client_packet_schemas = {
+    0x14: [],  # LeaveGame
+    0x1D: [],  # Ping
+    0x1E: [],  # PingBack
+    0x65: [],  # WalkNorth
+    0x66: [],  # WalkEast
+    0x67: [],  # WalkSouth
+    0x68: [],  # WalkWest
+    0x69: [],  # Stop
+    0x6A: [],  # WalkNorthEast
+    0x6B: [],  # WalkSouthEast
+    0x6C: [],  # WalkSouthWest
+    0x6D: [],  # WalkNorthWest
+    0x6F: [],  # TurnNorth
+    0x70: [],  # TurnEast
+    0x71: [],  # TurnSouth
+    0x72: [],  # TurnWest
+    0x8C: [('position', 'coordinates'),
+           ('thing_id', 'u16'),
+           ('stack_pos', 'byte')],  # Look
+    # Talk; only the public speak types (say, whisper, yell) are described.
+    # The private ones carry the receiver and the channel ones the channel.
+    0x96: [('speak_type', 'byte', PUBLIC_SPEAK_TYPES),
+           ('message', 'string')],
+    0xA1: [('creature_id', 'u32'),
+           ('sequence', 'u32')],  # Attack
+    0xA2: [('creature_id', 'u32'),
+           ('sequence', 'u32')],  # Follow
+    0xBE: [],  # CancelAttackAndFollow
+}
+
+server_packet_schemas = {
+    0x14: [('message', 'string')],  # LoginError
+    0x15: [('message', 'string')],  # LoginAdvice (FYI box)
+    0x16: [('message', 'string'),
+           ('time', 'byte')],  # LoginWait
+    0x0A: [],  # LoginOrPendingState
+    0x0F: [],  # EnterGame
+    # LoginSuccess; the speeds are doubles sent as a precision byte followed
+    # by a U32.
+    0x17: [('player_id', 'u32'),
+           ('beat_duration', 'u16'),
+           ('speed_a_precision', 'byte'),
+           ('speed_a', 'u32'),
+           ('speed_b_precision', 'byte'),
+           ('speed_b', 'u32'),
+           ('speed_c_precision', 'byte'),
+           ('speed_c', 'u32'),
+           ('can_report_bugs', 'byte')],
+    0x1D: [],  # PingBack
+    0x1E: [],  # Ping
+    0x1F: [('timestamp', 'u32'),
+           ('random_number', 'byte')],  # Challenge
+    0x6C: [('position', 'coordinates'),
+           ('stack_pos', 'byte')],  # DeleteOnMap
+    0x6D: [('from_position', 'coordinates'),
+           ('stack_pos', 'byte'),
+           ('to_position', 'coordinates')],  # MoveCreature
+    0x83: [('position', 'coordinates'),
+           ('effect', 'byte')],  # GraphicalEffect
+    0x8C: [('creature_id', 'u32'),
+           ('health_percent', 'byte')],  # CreatureHealth
+    # Talk; only the public speak types (say, whisper, yell) are described.
+    # The others carry no position, or a channel instead.
+    0xAA: [('statement_id', 'u32'),
+           ('name', 'string'),
+           ('level', 'u16'),
+           ('speak_type', 'byte', PUBLIC_SPEAK_TYPES),
+           ('position', 'coordinates'),
+           ('message', 'string')],
+    0xB5: [('direction', 'byte')],  # CancelWalk
+    0xB6: [('delay', 'u16')],  # WalkWait
+}
+
+_FIELD_FORMATS = {'byte': 'B', 'u16': 'H', 'u32': 'I', 'coordinates': 'HHB'}
+_U16 = struct.Struct("<H")
+_BYTE = struct.Struct("<B")
+
+
+def _fixedRuns(schema):
+    """Splits a schema into runs of fixed-size fields, separated by strings,
+    so that each run can be read or written with a single struct call.
+
+    Returns list (of lists of fields; a string field is a run on its own)
+    """
+    runs = []
+    run = []
+    for field in schema:
+        field_type = field[1]
+        if len(field) > 2 and field_type != 'byte':
+            raise ValueError("Only byte fields can be restricted: %s" %
+                             field[0])
+        if field_type == 'string':
+            if run:
+                runs += [run]
+                run = []
+            runs += [[field]]
+        elif field_type in _FIELD_FORMATS:
+            run += [field]
+        else:
+            raise ValueError("Unknown field type: %s" % field_type)
+    if run:
+        runs += [run]
+    return runs
+
+
+def compilePacketSchema(packet_type, schema):
+    """Turns a packet schema into a specialized parse function and a
+    specialized build function. The functions are generated as straight-line
+    Python code, with every run of fixed-size fields read or written by a
+    single precompiled struct.
+
+    >>> parse, build = compilePacketSchema(0xAA, server_packet_schemas[0xAA])
+    >>> from tibiaproxy.NetworkMessage import OutputMessage
+    >>> msg = OutputMessage()
+    >>> build(msg, {'statement_id': 3, 'name': '1', 'level': 1,
+    ...             'speak_type': 1, 'position': [96, 123, 7],
+    ...             'message': 'hi'})
+    >>> read = NetworkMessage.wrap(msg.getRaw())
+    >>> read.getByte() == 0xAA
+    True
+    >>> packet = parse(read)
+    >>> packet['name'], packet['position'], packet['message']
+    ('1', [96, 123, 7], 'hi')
+    >>> private = NetworkMessage.wrap(b'\\x00' * 4 + b'\\x01\\x001' +
+    ...                               b'\\x01\\x00\\x06\\x05\\x00hello')
+    >>> parse(private) is None
+    True
+
+    Args:
+        packet_type (int): the packet's opcode
+        schema (list): the packet's fields, see client_packet_schemas
+
+    Returns tuple (parse, build). parse(msg) reads the packet from a
+        NetworkMessage positioned right after the opcode and returns a
+        dictionary of its fields, with the opcode under 'packet_type', or
+        None if a restricted field rules the layout out. build(msg, packet)
+        writes the opcode and the fields to a message.
+    """
+    namespace = {'_U16': _U16}
+    parse = ["def parse(msg):",
+             "    buf = msg.buf",
+             "    pos = msg.pos"]
+    build = ["def build(msg, packet):",
+             "    msg.addByte(%d)" % packet_type]
+    values = ["'packet_type': %d" % packet_type]
+    for run in _fixedRuns(schema):
+        if run[0][1] == 'string':
+            name = run[0][0]
+            parse += ["    size = _U16.unpack_from(buf, pos)[0]",
+                      "    f_%s = bytes(buf[pos+2:pos+2+size])"
+                      ".decode('latin1')" % name,
+                      "    pos += 2 + size"]
+            build += ["    msg.addString(packet[%r])" % name]
+            values += ["%r: f_%s" % (name, name)]
+            continue
+        fields = struct.Struct(
+            "<" + "".join(_FIELD_FORMATS[field[1]] for field in run))
+        struct_name = "_s%d" % len(namespace)
+        namespace[struct_name] = fields
+        targets = []
+        arguments = []
+        checks = []
+        for field in run:
+            name, field_type = field[:2]
+            if field_type == 'coordinates':
+                targets += ["f_%s_%s" % (name, axis) for axis in "xyz"]
+                arguments += ["packet[%r][%d]" % (name, i) for i in range(3)]
+                values += ["%r: [f_%s_x, f_%s_y, f_%s_z]" % (
+                    name, name, name, name)]
+            else:
+                targets += ["f_%s" % name]
+                arguments += ["packet[%r]" % name]
+                values += ["%r: f_%s" % (name, name)]
+            if len(field) > 2:
+                allowed_name = "_a%d" % len(namespace)
+                namespace[allowed_name] = frozenset(field[2])
+                checks += ["    if f_%s not in %s:" % (name, allowed_name),
+                           "        return None"]
+        parse += ["    %s, = %s.unpack_from(buf, pos)" % (", ".join(targets),
+                                                          struct_name)]
+        parse += checks
+        parse += ["    pos += %d" % fields.size]
+        build += ["    msg.addBytes(%s.pack(%s))" % (struct_name,
+                                                     ", ".join(arguments))]
+    parse += ["    msg.pos = pos",
+              "    return {%s}" % ", ".join(values)]
+    exec("\n".join(parse) + "\n\n" + "\n".join(build), namespace)
+    return namespace['parse'], namespace['build']
+
+
+def compilePacketSkipper(schema):
+    """Turns a packet schema into a function that skips over the packet
+    without decoding its fields, so that the packets nobody is interested in
+    cost next to nothing.
+
+    >>> skip = compilePacketSkipper(server_packet_schemas[0xAA])
+    >>> msg = NetworkMessage.wrap(b'\\x00' * 4 + b'\\x01\\x001' +
+    ...                           b'\\x01\\x00\\x01' + b'\\x00' * 5 +
+    ...                           b'\\x02\\x00hi')
+    >>> skip(msg)
+    True
+    >>> msg.getPos() == len(msg.getRaw())
+    True
+
+    Args:
+        schema (list): the packet's fields, see client_packet_schemas
+
+    Returns function (skip(msg), moving msg past the packet's fields and
+        returning True, or returning False if a restricted field rules the
+        layout out)
+    """
+    namespace = {'_U16': _U16, '_BYTE': _BYTE}
+    skip = ["def skip(msg):",
+            "    buf = msg.buf",
+            "    pos = msg.pos"]
+    for run in _fixedRuns(schema):
+        if run[0][1] == 'string':
+            skip += ["    pos += 2 + _U16.unpack_from(buf, pos)[0]"]
+            continue
+        offset = 0
+        for field in run:
+            if len(field) > 2:
+                allowed_name = "_a%d" % len(namespace)
+                namespace[allowed_name] = frozenset(field[2])
+                skip += ["    if _BYTE.unpack_from(buf, pos + %d)[0] not in "
+                         "%s:" % (offset, allowed_name),
+                         "        return False"]
+            offset += struct.calcsize("<" + _FIELD_FORMATS[field[1]])
+        skip += ["    pos += %d" % offset]
+    skip += ["    msg.pos = pos",
+             "    return True"]
+    exec("\n".join(skip), namespace)
+    return namespace['skip']
+
+
+def _compileSchemas(schemas):
+    """Compiles a whole table of packet schemas.
+
+    Returns tuple (dictionaries of parse, build and skip functions, all keyed
+        by the opcode)
+    """
+    parsers = {}
+    builders = {}
+    skippers = {}
+    for packet_type, schema in schemas.items():
+        parse, build = compilePacketSchema(packet_type, schema)
+        parsers[packet_type] = parse
+        builders[packet_type] = build
+        skippers[packet_type] = compilePacketSkipper(schema)
+    return parsers, builders, skippers
+
+
+(client_packet_parsers, client_packet_builders,
+ client_packet_skippers) = _compileSchemas(client_packet_schemas)
+(server_packet_parsers, server_packet_builders,
+ server_packet_skippers) = _compileSchemas(server_packet_schemas)
+
+
+def parsePacket(msg, parsers):
+    """Reads the next packet of a decrypted message: its opcode and, if the
+    packet has a schema, its fields.
+
+    Args:
+        msg (NetworkMessage): the message, positioned at the packet's opcode
+        parsers (dict): client_packet_parsers or server_packet_parsers
+
+    Returns dict or None (if the packet's layout is unknown; the opcode is
+        consumed anyway)
+    """
+    packet_type = msg.getByte()
+    parse = parsers.get(packet_type)
+    if parse is None:
+        return None
+    return parse(msg)
+
+
+def iterPackets(msg, parsers, wanted=None, skippers=None):
+    """Reads the packets of a decrypted message one by one. Stops after the
+    first packet whose layout is unknown, since there is no telling where it
+    ends, and at a truncated packet.
+
+    Args:
+        msg (NetworkMessage): the message, positioned at the first opcode
+        parsers (dict): client_packet_parsers or server_packet_parsers
+        wanted (set): if given, only the packets with these opcodes are
+            decoded; the others are skipped over with skippers and are not
+            yielded, unless their layout is unknown.
+        skippers (dict): client_packet_skippers or server_packet_skippers,
+            required along with wanted
+
+    Returns generator of tuples (the opcode and the packet as returned by
+        parsePacket)
+    """
+    while msg.finished():
+        try:
+            packet_type = msg.getByte()
+            if wanted is not None and packet_type not in wanted and \
+                    packet_type in skippers:
+                if not skippers[packet_type](msg):
+                    return
+                continue
+            parse = parsers.get(packet_type)
+            packet = None if parse is None else parse(msg)
+        except struct.error:
+            return
+        if msg.getPos() > len(msg.getRaw()):
+            return
+        yield packet_type, packet
+        if packet is None:
+            return
+
+
+def buildPacket(msg, packet, builders):
+    """Writes a packet, as returned by parsePacket, to a message.
+
+    Args:
+        msg (NetworkMessage): the message to write to, e.g. an OutputMessage
+        packet (dict): the packet's fields, along with its 'packet_type'
+        builders (dict): client_packet_builders or server_packet_builders
+
+    Returns None
+    """
+    builders[packet['packet_type']](msg, packet)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
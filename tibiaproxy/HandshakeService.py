@@ -0,0 +1,111 @@
+"""
+HandshakeService.py - runs the RSA work of the login and game handshakes,
+optionally in a pool of worker processes.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+from tibiaproxy import RSA
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+
+
+def _ping(x):
+    """Used to start up the worker processes before they are needed."""
+    return x
+
+
+class HandshakeService(object):
+    """Performs RSA decryption and encryption for the handshakes.
+
+    With no workers, the work is done on the calling thread. Otherwise it is
+    submitted to a pool of worker processes and the calling thread just waits
+    for the result, which releases the GIL, so that the sessions that are
+    already relaying are not stalled by a wave of new logins.
+    """
+
+    def __init__(self, workers=0):
+        """Create a HandshakeService instance.
+
+        Args:
+            workers (int): the number of worker processes; 0 runs the RSA
+                operations on the calling thread.
+        """
+        self.workers = workers
+        self.executor = None
+        if workers > 0 and ProcessPoolExecutor is not None:
+            self.executor = ProcessPoolExecutor(workers)
+            # Fork the workers now, before any connection threads exist.
+            list(self.executor.map(_ping, range(workers)))
+
+    def submit_decrypt(self, c_bin, n=RSA.otserv_n):
+        """Starts decrypting an RSA block. See RSA.RSA_decrypt.
+
+        Returns Future, or bytes if there are no workers
+        """
+        if self.executor is None:
+            return RSA.RSA_decrypt(c_bin, n)
+        return self.executor.submit(RSA.RSA_decrypt, bytes(c_bin), n)
+
+    def submit_encrypt(self, m_bin, n=RSA.tibia_n, e=65537):
+        """Starts encrypting an RSA block. See RSA.RSA_encrypt.
+
+        Returns Future, or bytes if there are no workers
+        """
+        if self.executor is None:
+            return RSA.RSA_encrypt(m_bin, n, e)
+        return self.executor.submit(RSA.RSA_encrypt, bytes(m_bin), n, e)
+
+    def decrypt(self, c_bin, n=RSA.otserv_n):
+        """Decrypts an RSA block. See RSA.RSA_decrypt.
+
+        Returns bytes
+        """
+        return result(self.submit_decrypt(c_bin, n))
+
+    def encrypt(self, m_bin, n=RSA.tibia_n, e=65537):
+        """Encrypts an RSA block. See RSA.RSA_encrypt.
+
+        Returns bytes
+        """
+        return result(self.submit_encrypt(m_bin, n, e))
+
+    def shutdown(self):
+        """Stops the worker processes, if any.
+
+        Returns None
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def result(submitted):
+    """Waits for the value returned by one of the submit_* methods.
+
+    Returns bytes
+    """
+    if hasattr(submitted, 'result'):
+        return submitted.result()
+    return submitted
+
+
+# Used by the protocol functions when no service is passed to them.
+inline = HandshakeService()
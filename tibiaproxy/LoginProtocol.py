@@ -18,8 +18,8 @@ LoginProtocol.py - contains code needed to handle the login protocol.
 #along with Foobar; if not, write to the Free Software
 #Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
-from tibiaproxy.NetworkMessage import NetworkMessage
-from tibiaproxy import RSA
+from tibiaproxy.NetworkMessage import NetworkMessage, OutputMessage
+from tibiaproxy import HandshakeService
 from tibiaproxy import XTEA
 from tibiaproxy.util import log
 
@@ -36,18 +36,21 @@ def create_login_reply_info(characters, motd, worlds):
     return {'characters': characters, 'motd': motd, 'worlds': worlds}
 
 
-def parseFirstMessage(msg):
+def parseFirstMessage(msg, handshake=None):
     """Parse the first (client's) message from the login protocol.
 
     Args:
         msg (NetworkMessage): the network message to be parsed.
-        skip_bytes (int): the offset at which is the RSA-encrypted message.
+        handshake (HandshakeService): runs the RSA decryption; defaults to
+            doing it on the calling thread.
 
     Returns list
     """
+    handshake = handshake or HandshakeService.inline
     msg.skipBytes(28)
-    msg_buf = RSA.RSA_decrypt(msg.getRest()[:128])
-    msg = NetworkMessage(msg_buf)
+    msg_buf = handshake.decrypt(msg.getRest()[:128])
+    msg = NetworkMessage.wrap(msg_buf)
+    assert(msg.getByte() == 0)  # RSA block padding
     # Extract the XTEA keys from the RSA-decrypted message.
     return [msg.getU32() for _ in range(4)]
 
@@ -66,7 +69,7 @@ def parseReply(msg, xtea_key):
     msg.skipBytes(4)
 
     msg_buf = XTEA.XTEA_decrypt(msg.getRest(), xtea_key)
-    msg = NetworkMessage(msg_buf)
+    msg = NetworkMessage.wrap(msg_buf)
     #assert(len(msg.getWithHeader()) == size)
     decrypted_size = msg.getU16()
     #assert(decrypted_size == size - 5)
@@ -111,10 +114,10 @@ def prepareReply(login_reply):
         login_reply (dict): the login_reply structure used to build
             the response.
 
-    Returns NetworkMessage
+    Returns OutputMessage
     """
 
-    ret = NetworkMessage()
+    ret = OutputMessage()
     ret.addByte(0x14)
     ret.addString(login_reply['motd'])
     ret.addByte(0x64)
@@ -20,7 +20,13 @@ custom ones.
 
 import copy
 import struct
-from tibiaproxy import XTEA
+from tibiaproxy import FrameCodec
+
+# Precompiled structures, so that reading a field is a single unpack_from
+# call straight on the buffer, without slicing it first.
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_COORDINATES = struct.Struct("<HHB")
 
 
 def adlerChecksum(buf):
@@ -32,27 +38,15 @@ def adlerChecksum(buf):
 
     Returns int
     """
-    length = len(buf)
-    adler = 65521
-    a = 1
-    b = 0
-    pos = 0
-    while length > 0:
-        tmp = 5552 if length > 5552 else length
-        length -= tmp
-        for _ in reversed(range(tmp)):
-            a += buf[pos]
-            b += a
-            pos += 1
-        a %= adler
-        b %= adler
-    return (b << 16) | a
+    return FrameCodec.adler32(buf)
 
 
 class NetworkMessage(object):
     """A utility class used to extract structures out of network messages and
     build custom ones."""
 
+    __slots__ = ('buf', 'pos')
+
     def __init__(self, buf=None):
         """Create a NetworkMessage instance.
 
@@ -65,6 +59,27 @@ class NetworkMessage(object):
         self.buf = bytearray(buf) if buf is not None else bytearray()
         self.pos = 0
 
+    @classmethod
+    def wrap(cls, buf):
+        """Create a NetworkMessage reading straight from the given buffer,
+        without copying it. The buffer must not change while the message is
+        being read.
+
+        >>> msg = NetworkMessage.wrap(memoryview(b'\\x01\\x00\\x02\\x00\\x07'))
+        >>> msg.getCoordinates()
+        [1, 2, 7]
+
+        Args:
+            buf (memoryview): the buffer to be read; anything supporting the
+                buffer protocol will do.
+
+        Returns NetworkMessage
+        """
+        msg = cls.__new__(cls)
+        msg.buf = buf
+        msg.pos = 0
+        return msg
+
     def getByte(self):
         """Returns the next unprocessed unsigned 8-bit integer.
 
@@ -79,7 +94,7 @@ class NetworkMessage(object):
 
         Returns int
         """
-        u32 = struct.unpack("<I", bytes(self.buf[self.pos:self.pos+4]))[0]
+        u32 = _U32.unpack_from(self.buf, self.pos)[0]
         self.pos += 4
         return u32
 
@@ -88,7 +103,7 @@ class NetworkMessage(object):
 
         Returns int
         """
-        u16 = struct.unpack("<H", bytes(self.buf[self.pos:self.pos+2]))[0]
+        u16 = _U16.unpack_from(self.buf, self.pos)[0]
         self.pos += 2
         return u16
 
@@ -98,12 +113,18 @@ class NetworkMessage(object):
         Returns str
         """
         size = self.getU16()
-        ret = self.buf[self.pos:self.pos+size]
+        ret = bytes(self.buf[self.pos:self.pos+size])
         self.pos += size
         return ret.decode('latin1')
 
     def getCoordinates(self):
-        return [self.getU16(), self.getU16(), self.getByte()]
+        """Returns the next unprocessed position: x and y (U16) and z (byte).
+
+        Returns list
+        """
+        ret = list(_COORDINATES.unpack_from(self.buf, self.pos))
+        self.pos += 5
+        return ret
 
     def skipBytes(self, _bytes):
         """Skips a number of bytes from the network message.
@@ -116,7 +137,8 @@ class NetworkMessage(object):
         self.pos += _bytes
 
     def getRest(self):
-        """Returns the unprocessed part of the network message.
+        """Returns the unprocessed part of the network message. For wrapped
+        memoryviews, this does not copy the data.
 
         Returns str
         """
@@ -126,15 +148,16 @@ class NetworkMessage(object):
         """Returns the unencrypted buffer for the network message with the
         required padding and size header, ready for XTEA encryption.
 
-        Returns str
+        Returns bytearray
         """
         ret = copy.copy(self.buf)
-        # Add the padding
+        # Add the padding, so that the size header and the body make up full
+        # XTEA blocks.
         size = len(ret)
-        for _ in range(8 - (size) % 8):
+        for _ in range((8 - (size + 2) % 8) % 8):
             ret += bytearray([0x33])
 
-        ret_with_size = struct.pack("<H", size) + ret
+        ret_with_size = bytearray(struct.pack("<H", size)) + ret
         return ret_with_size
 
     def getEncrypted(self, xtea_key):
@@ -142,14 +165,12 @@ class NetworkMessage(object):
         wire. Adds all the necessary headers, encryption and checksums.
 
         Args:
-            xtea_key (list): XTEA key; a four-element-long array of integers
+            xtea_key (XTEACipher or list): the session's XTEA cipher, or the
+                raw XTEA key; a four-element-long array of integers
 
-        Returns str
+        Returns bytearray
         """
-        ret_encrypted = XTEA.XTEA_encrypt(self.getWithHeader(), xtea_key)
-        checksum = adlerChecksum(ret_encrypted)
-        ret_encrypted = struct.pack("<I", checksum) + ret_encrypted
-        return struct.pack("<H", len(ret_encrypted)) + ret_encrypted
+        return FrameCodec.FrameCodec(xtea_key).encode(self.buf)
 
     def getRaw(self):
         """Returns the raw buffer without any additional headers.
@@ -159,7 +180,12 @@ class NetworkMessage(object):
         return self.buf
 
     def peekU16(self):
-        return struct.unpack("<H", bytes(self.buf[self.pos:self.pos+2]))[0]
+        """Returns the next unprocessed unsigned 16-bit integer without
+        consuming it.
+
+        Returns int
+        """
+        return _U16.unpack_from(self.buf, self.pos)[0]
 
     def addByte(self, byte):
         """Adds a unsigned 8-bit integer to the end of the network message.
@@ -229,6 +255,16 @@ class NetworkMessage(object):
         self.buf += struct.pack("<H", len(_str))
         self.buf += _str.encode('latin1')
 
+    def addBytes(self, buf):
+        """Adds raw bytes to the end of the network message.
+
+        Args:
+            buf (bytearray): the bytes to be appended to the network message
+
+        Returns None
+        """
+        self.buf += buf
+
     def getPos(self):
         """Returns the current position in the buffer
 
@@ -261,3 +297,268 @@ class NetworkMessage(object):
 
     def finished(self):
         return self.pos < len(self.buf)
+
+
+class OutputMessage(NetworkMessage):
+    """A network message built for sending. The buffer is allocated with
+    room for the frame headers and a few prepended bytes in front of the
+    message, grows by doubling and is turned into the frame in place, so the
+    message is never copied.
+
+    >>> msg = OutputMessage()
+    >>> msg.addByte(0x14)
+    >>> msg.addString("hello")
+    >>> msg.getRaw().tobytes() == b'\\x14\\x05\\x00hello'
+    True
+    >>> frame = msg.getEncrypted([1, 2, 3, 4])
+    >>> FrameCodec.FrameCodec([1, 2, 3, 4]).decode(frame).tobytes()[3:]
+    b'hello'
+    >>> msg = OutputMessage()
+    >>> msg.addByte(0x14)
+    >>> start = msg.start
+    >>> msg.prependU16(1)
+    >>> msg.start == start - 2, msg.getRaw().tobytes()
+    (True, b'\\x01\\x00\\x14')
+    """
+
+    __slots__ = ('start', 'end')
+
+    # The frame size (U16), checksum (U32) and message size (U16).
+    HEADER_SIZE = FrameCodec.HEADER_SIZE + 2
+
+    # The room left for prepending in front of the headers.
+    HEADROOM = 8
+
+    def __init__(self, capacity=64):
+        """Create an OutputMessage instance.
+
+        Args:
+            capacity (int): the initial room for the message, in bytes. The
+                buffer grows as needed.
+        """
+        self.buf = bytearray(self.HEADER_SIZE + self.HEADROOM + capacity)
+        self.pos = self.HEADER_SIZE + self.HEADROOM
+        self.start = self.pos
+        self.end = self.pos
+
+    def reserve(self, size):
+        """Makes sure that size more bytes (plus the padding) fit after the
+        end of the message, doubling the buffer if they do not.
+
+        Args:
+            size (int): the number of bytes about to be added
+
+        Returns None
+        """
+        needed = self.end + size + 8
+        if needed > len(self.buf):
+            grown = bytearray(max(2 * len(self.buf), needed))
+            grown[:self.end] = memoryview(self.buf)[:self.end]
+            self.buf = grown
+
+    def addByte(self, byte):
+        """Adds a unsigned 8-bit integer to the end of the network message.
+
+        Args:
+            byte (int): the unsigned 8-bit integer to be appended to the
+                network message
+
+        Returns None
+        """
+        self.reserve(1)
+        self.buf[self.end] = byte
+        self.end += 1
+
+    def addU32(self, u32):
+        """Adds an unsigned 32-bit integer to the end of the network message.
+
+        Args:
+            u32 (int): the unsigned 32-bit integer to be appended to the
+                network message
+
+        Returns None
+        """
+        self.reserve(4)
+        _U32.pack_into(self.buf, self.end, u32)
+        self.end += 4
+
+    def addU16(self, u16):
+        """Adds an unsigned 16-bit integer to the end of the network message.
+
+        Args:
+            u16 (int): the unsigned 16-bit integer to be appended to the
+                network message
+
+        Returns None
+        """
+        self.reserve(2)
+        _U16.pack_into(self.buf, self.end, u16)
+        self.end += 2
+
+    def addString(self, _str):
+        """Adds a string to the end of the network message.
+
+        Args:
+            _str (str): the string to be appended to the network message
+
+        Returns None
+        """
+        encoded = _str.encode('latin1')
+        self.reserve(2 + len(encoded))
+        _U16.pack_into(self.buf, self.end, len(encoded))
+        self.end += 2
+        self.buf[self.end:self.end+len(encoded)] = encoded
+        self.end += len(encoded)
+
+    def addBytes(self, buf):
+        """Adds raw bytes to the end of the network message.
+
+        Args:
+            buf (bytearray): the bytes to be appended to the network message
+
+        Returns None
+        """
+        self.reserve(len(buf))
+        self.buf[self.end:self.end+len(buf)] = buf
+        self.end += len(buf)
+
+    def prependU16(self, u16):
+        """Adds an unsigned 16-bit integer to the beginning of the network
+        message.
+
+        Args:
+            u16 (int): the unsigned 16-bit integer to be prepended to the
+                network message
+
+        Returns None
+        """
+        self._makeHeadroom(2)
+        self.start -= 2
+        _U16.pack_into(self.buf, self.start, u16)
+
+    def prependU32(self, u32):
+        """Adds an unsigned 32-bit integer to the beginning of the network
+        message.
+
+        Args:
+            u32 (int): the unsigned 32-bit integer to be prepended to the
+                network message
+
+        Returns None
+        """
+        self._makeHeadroom(4)
+        self.start -= 4
+        _U32.pack_into(self.buf, self.start, u32)
+
+    def _makeHeadroom(self, size):
+        """Makes sure that size bytes plus the frame headers fit in front of
+        the message. Only prepending past the reserved headroom moves data.
+
+        Returns None
+        """
+        needed = self.HEADER_SIZE + size
+        if self.start >= needed:
+            return
+        shift = needed - self.start + self.HEADROOM
+        self.reserve(shift)
+        self.buf[self.start+shift:self.end+shift] = \
+            self.buf[self.start:self.end]
+        self.start += shift
+        self.end += shift
+        self.pos = self.start
+
+    def getRaw(self):
+        """Returns the message without any additional headers, as a view of
+        the buffer.
+
+        Returns memoryview
+        """
+        return memoryview(self.buf)[self.start:self.end]
+
+    def getWithHeader(self):
+        """Returns the unencrypted message with the required padding and size
+        header, ready for XTEA encryption. Written in place, as a view of the
+        buffer.
+
+        Returns memoryview
+        """
+        msg_size = self.end - self.start
+        body_start = self.start - 2
+        body_end = body_start + FrameCodec.padded_size(msg_size)
+        self.buf[self.end:body_end] = b'\x33' * (body_end - self.end)
+        _U16.pack_into(self.buf, body_start, msg_size)
+        return memoryview(self.buf)[body_start:body_end]
+
+    def getEncrypted(self, xtea_key):
+        """Returns the network message in a form ready to be sent over the
+        wire. The padding, headers and checksum are filled in and the message
+        is encrypted in place, so nothing may be added to it afterwards.
+
+        Args:
+            xtea_key (XTEACipher or list): the session's XTEA cipher, or the
+                raw XTEA key; a four-element-long array of integers
+
+        Returns memoryview
+        """
+        codec = FrameCodec.FrameCodec(xtea_key)
+        return codec.encode_into(self.buf, self.start, self.end - self.start)
+
+    def finished(self):
+        return self.pos < self.end
+
+
+class MessagePool(object):
+    """A session's freelist of reader messages, so that relaying a frame
+    reuses them instead of allocating new ones.
+
+    >>> pool = MessagePool()
+    >>> msg = pool.wrap(b'\\x07')
+    >>> msg.getByte()
+    7
+    >>> pool.release(msg)
+    >>> pool.wrap(b'') is msg
+    True
+    """
+
+    __slots__ = ('messages', 'max_free')
+
+    def __init__(self, max_free=4):
+        """Create a MessagePool instance.
+
+        Args:
+            max_free (int): how many unused messages to keep
+        """
+        self.messages = []
+        self.max_free = max_free
+
+    def wrap(self, buf):
+        """Returns a message reading from buf, like NetworkMessage.wrap, but
+        reusing a released message object if there is one.
+
+        Args:
+            buf (memoryview): the buffer to be read
+
+        Returns NetworkMessage
+        """
+        if not self.messages:
+            return NetworkMessage.wrap(buf)
+        msg = self.messages.pop()
+        msg.buf = buf
+        msg.pos = 0
+        return msg
+
+    def release(self, msg):
+        """Hands a message back to the pool. It must not be used afterwards.
+
+        Args:
+            msg (NetworkMessage): the message obtained from wrap()
+
+        Returns None
+        """
+        msg.buf = None
+        if len(self.messages) < self.max_free:
+            self.messages += [msg]
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,117 @@
+"""
+Passthrough.py - moves the bytes of one direction of a session from socket
+to socket without looking at them, in the kernel where possible.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import errno
+import os
+
+
+class Passthrough(object):
+    """Relays whatever arrives on one blocking socket to another. On Linux
+    (Python 3.10+), the data goes socket -> pipe -> socket with os.splice and
+    never enters the process; elsewhere, or if the sockets do not support
+    splicing, it is copied through one large reusable buffer.
+
+    >>> import socket
+    >>> a, b = socket.socketpair()
+    >>> c, d = socket.socketpair()
+    >>> pump = Passthrough(b, c)
+    >>> _ = a.send(b'hello')
+    >>> pump.pump()
+    5
+    >>> d.recv(5)
+    b'hello'
+    >>> a.close()
+    >>> pump.pump()
+    0
+    >>> pump.close()
+    """
+
+    def __init__(self, src, dst, chunk=1 << 16):
+        """Create a Passthrough instance.
+
+        Args:
+            src (socket): the socket to read from
+            dst (socket): the socket to write to
+            chunk (int): the most bytes moved per pump() call
+        """
+        self.src = src
+        self.dst = dst
+        self.chunk = chunk
+        self.pipe = None
+        self.buf = None
+        if hasattr(os, 'splice'):
+            self.pipe = os.pipe()
+        else:
+            self._useBuffer()
+
+    def _useBuffer(self):
+        """Switches to copying through a buffer.
+
+        Returns None
+        """
+        self.close()
+        self.buf = memoryview(bytearray(self.chunk))
+
+    def pump(self):
+        """Moves whatever the source socket has got, up to chunk bytes. Blocks
+        if there is nothing to read, so call it once the socket is readable.
+
+        Returns int (the number of bytes moved; 0 if the source disconnected)
+        """
+        if self.pipe is not None:
+            try:
+                return self._splice()
+            except OSError as e:
+                # Not every kind of socket can be spliced.
+                if e.errno != errno.EINVAL:
+                    raise
+                self._useBuffer()
+        received = self.src.recv_into(self.buf)
+        self.dst.sendall(self.buf[:received])
+        return received
+
+    def _splice(self):
+        """Moves the data through the pipe, without copying it to user space.
+
+        Returns int
+        """
+        pipe_r, pipe_w = self.pipe
+        moved = os.splice(self.src.fileno(), pipe_w, self.chunk,
+                          flags=os.SPLICE_F_MOVE)
+        left = moved
+        while left > 0:
+            left -= os.splice(pipe_r, self.dst.fileno(), left,
+                              flags=os.SPLICE_F_MOVE)
+        return moved
+
+    def close(self):
+        """Releases the pipe, if any. The sockets are left open.
+
+        Returns None
+        """
+        if self.pipe is not None:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
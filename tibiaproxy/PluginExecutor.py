@@ -0,0 +1,149 @@
+"""
+PluginExecutor.py - runs the plugin hooks away from the relay, giving up on
+the ones that take too long.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+from tibiaproxy.ConnectionScheduler import WorkerPool
+from tibiaproxy.util import log
+
+
+class _Call(object):
+    """A submitted function whose outcome is reported exactly once: its
+    result if it finishes first, None if the deadline comes first."""
+
+    def __init__(self, func, done):
+        self.func = func
+        self.done = done
+        self.lock = threading.Lock()
+        self.finished = False
+
+    def run(self):
+        """Runs the function on a worker thread.
+
+        Returns None
+        """
+        try:
+            result = self.func()
+        except Exception:
+            log(traceback.format_exc())
+            result = None
+        self.finish(result)
+
+    def expire(self):
+        """Gives up on the function, if it is not done yet.
+
+        Returns None
+        """
+        if self.finish(None):
+            log("A plugin hook ran out of time")
+
+    def finish(self, result):
+        """Reports the outcome, unless it already was.
+
+        Returns bool (whether it was reported now)
+        """
+        with self.lock:
+            if self.finished:
+                return False
+            self.finished = True
+        self.done(result)
+        return True
+
+
+class PluginExecutor(object):
+    """A bounded pool of threads running the plugin hooks of the relayed
+    frames. Each call has timeout seconds to finish, after which its outcome
+    is reported as None while the call itself is left to finish on its own,
+    since threads cannot be stopped; a hook that may never finish should do
+    its work in another process (see Sandbox).
+
+    >>> executor = PluginExecutor(threads=1, timeout=0.2)
+    >>> results = []
+    >>> executor.submit(lambda: True, results.append)
+    >>> executor.submit(lambda: time.sleep(1), results.append)
+    >>> time.sleep(0.5)
+    >>> results
+    [True, None]
+    """
+
+    def __init__(self, threads, timeout, max_queued=256):
+        """Create a PluginExecutor instance and start its threads.
+
+        Args:
+            threads (int): the number of threads running the hooks
+            timeout (float): how long a call may take, waiting for a thread
+                included, in seconds
+            max_queued (int): the most calls waiting for a thread; the ones
+                that do not fit are not run at all
+        """
+        self.timeout = timeout
+        self.pool = WorkerPool("plugin", threads, max_queued, timeout)
+        # (deadline, sequence number, _Call), the soonest first.
+        self.deadlines = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        t = threading.Thread(target=self.watch)
+        t.daemon = True
+        t.start()
+
+    def submit(self, func, done):
+        """Runs func() on one of the threads. done is then called with what
+        func returned, or with None if func raised an exception, ran out of
+        time or could not be queued. It is called from one of the executor's
+        threads, or right away.
+
+        Args:
+            func (function): takes no arguments
+            done (function): takes the result
+
+        Returns None
+        """
+        call = _Call(func, done)
+        with self.cond:
+            heapq.heappush(self.deadlines, (time.time() + self.timeout,
+                                            next(self.counter), call))
+            self.cond.notify()
+        self.pool.submit(call.run, [], call.expire)
+
+    def watch(self):
+        """The body of the thread that expires the calls past their deadline.
+
+        Returns None
+        """
+        while True:
+            with self.cond:
+                while not self.deadlines:
+                    self.cond.wait()
+                deadline, _, call = self.deadlines[0]
+                wait = deadline - time.time()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                heapq.heappop(self.deadlines)
+            call.expire()
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
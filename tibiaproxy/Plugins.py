@@ -0,0 +1,134 @@
+"""
+Plugins.py - keeps track of which packets the loaded plugins are interested
+in and passes the packets to them.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# The client's "say" packet, which on_client_say subscribes to.
+SAY = 0x96
+
+
+def _onClientSay(hook):
+    """Adapts an on_client_say(conn, msg) hook to the generic packet hook.
+
+    Returns function
+    """
+    def handler(conn, packet):
+        return hook(conn, packet['message'])
+    return handler
+
+
+class PluginRegistry(object):
+    """Collects the subscriptions of the plugins. A plugin subscribes to
+    packets by defining any of:
+
+    * on_client_say(conn, msg) - called with the text the player said,
+    * on_client_packet(conn, packet) along with client_packets, a list of the
+      opcodes of the client's packets it wants to see,
+    * on_server_packet(conn, packet) along with server_packets, the same for
+      the server's packets.
+
+    A hook that returns True stops the frame that carried the packet from
+    being forwarded. The conn it gets (a Server.Connection) queues packets
+    for either side, which go out in one frame per side once the relayed
+    frames are handled.
+
+    >>> class Plugin(object):
+    ...     server_packets = [0xAA]
+    ...     def on_client_say(self, conn, msg):
+    ...         return msg == 'drop me'
+    ...     def on_server_packet(self, conn, packet):
+    ...         return False
+    >>> registry = PluginRegistry([Plugin()])
+    >>> sorted(registry.opcodes('C')), sorted(registry.opcodes('S'))
+    ([150], [170])
+    >>> registry.dispatch('C', None, SAY, {'message': 'drop me'})
+    True
+    >>> registry.dispatch('C', None, 0x14, {})
+    False
+    >>> PluginRegistry([]).subscribed('S')
+    False
+    >>> len(registry.table['S'][0xAA]), len(registry.table['S'][0x15])
+    (1, 0)
+    """
+
+    def __init__(self, plugins):
+        """Create a PluginRegistry instance.
+
+        Args:
+            plugins (list): the loaded plugin modules
+        """
+        self.plugins = plugins
+        # Direction ("C" or "S") -> the tuple of handlers of each opcode,
+        # so that dispatching a packet only touches its own handlers.
+        self.table = {'C': [()] * 256, 'S': [()] * 256}
+        for plugin in plugins:
+            if hasattr(plugin, 'on_client_say'):
+                self.subscribe('C', [SAY], _onClientSay(plugin.on_client_say))
+            if hasattr(plugin, 'on_client_packet'):
+                self.subscribe('C', getattr(plugin, 'client_packets', []),
+                               plugin.on_client_packet)
+            if hasattr(plugin, 'on_server_packet'):
+                self.subscribe('S', getattr(plugin, 'server_packets', []),
+                               plugin.on_server_packet)
+
+    def subscribe(self, direction, opcodes, handler):
+        """Registers a handler for the given packets.
+
+        Args:
+            direction (str): "C" for the client's packets, "S" for the
+                server's
+            opcodes (list): the opcodes of the packets (0-255)
+            handler (function): called as handler(conn, packet)
+
+        Returns None
+        """
+        table = self.table[direction]
+        for opcode in set(opcodes):
+            table[opcode] += (handler,)
+
+    def opcodes(self, direction):
+        """Returns set (the opcodes anybody subscribed to in the direction)"""
+        table = self.table[direction]
+        return set(opcode for opcode in range(256) if table[opcode])
+
+    def subscribed(self, direction):
+        """Returns bool (whether the frames of the direction need decoding)"""
+        return any(self.table[direction])
+
+    def dispatch(self, direction, conn, packet_type, packet):
+        """Passes a parsed packet to the handlers subscribed to it.
+
+        Args:
+            direction (str): "C" for the client's packets, "S" for the
+                server's
+            conn (Connection): the session the packet belongs to
+            packet_type (int): the packet's opcode
+            packet (dict): the packet, as returned by GameProtocol.parsePacket
+
+        Returns bool (True if the frame should not be forwarded)
+        """
+        drop = False
+        for handler in self.table[direction][packet_type]:
+            if handler(conn, packet):
+                drop = True
+        return drop
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,94 @@
+"""
+Preconnect.py - opens the connection to a game server before the proxy knows
+for sure that it is going to need it.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import errno
+import selectors
+import socket
+
+
+class Preconnect(object):
+    """A speculative connection. The connect() is started right away without
+    blocking, so it proceeds while the client is still busy with its part of
+    the handshake; take() then either hands the connection over or, if the
+    guess was wrong, throws it away.
+
+    >>> listener = socket.socket()
+    >>> listener.bind(('127.0.0.1', 0))
+    >>> listener.listen(1)
+    >>> address = listener.getsockname()
+    >>> Preconnect(address).take(('127.0.0.2', 1)) is None
+    True
+    >>> sock = Preconnect(address).take(address)
+    >>> sock.getpeername() == address
+    True
+    """
+
+    def __init__(self, address):
+        """Create a Preconnect instance, starting the connection.
+
+        Args:
+            address (tuple): the host and port guessed
+        """
+        self.address = address
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        err = self.sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.close()
+
+    def take(self, address, timeout=None):
+        """Hands over the connection if it goes to the given address and was
+        established; closes it otherwise.
+
+        Args:
+            address (tuple): the host and port actually needed
+            timeout (float): how long to wait for the connection to be
+                established, in seconds
+
+        Returns socket (connected and blocking) or None
+        """
+        if self.sock is None or address != self.address:
+            self.close()
+            return None
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.sock, selectors.EVENT_WRITE)
+            writable = selector.select(timeout)
+        if not writable or self.sock.getsockopt(socket.SOL_SOCKET,
+                                                socket.SO_ERROR) != 0:
+            self.close()
+            return None
+        sock = self.sock
+        self.sock = None
+        sock.setblocking(True)
+        return sock
+
+    def close(self):
+        """Throws the connection away, if it is still there.
+
+        Returns None
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -18,6 +18,7 @@ Pure-python RSA implementation, along with OpenTibia and Tibia keys.
 #along with Foobar; if not, write to the Free Software
 #Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import binascii
 import sys
 
 
@@ -61,51 +62,119 @@ tibia_n = toint("""
 
 
 def buf_to_int(buf):
-    """Converts the given buffer to a decimal form, ready for RSA operations.
+    """Converts the given big-endian buffer to an integer, ready for RSA
+    operations.
+
+    >>> buf_to_int(bytearray([1, 0]))
+    256
 
     Args:
         buf (bytearray): the buffer to be converted
 
     Returns int
     """
-    # first, convert each character to hexadecimal.
-    zero_padded = ""
-    for i in buf:
-        without_0x = hex(i).replace('0x', '')
-        space_padded = "%2s" % without_0x
-        zero_padded += space_padded.replace(' ', '0')
+    return int(binascii.hexlify(bytes(buf)) or b'0', 16)
 
-    # convert each byte to hex, then join it together and convert to int
-    return int(zero_padded, 16)
 
+def int_to_buf(num, size=None):
+    """Converts the given integer to a big-endian buffer.
 
-def int_to_buf(num):
-    """Converts the given buffer to a decimal form, ready for RSA operations.
+    >>> int_to_buf(256) == b'\\x01\\x00'
+    True
+    >>> int_to_buf(256, 4) == b'\\x00\\x00\\x01\\x00'
+    True
 
     Args:
-        buf (bytearray): the buffer to be converted
+        num (int): the integer to be converted
+        size (int): the width of the result in bytes; if not given, the
+            shortest buffer that can hold the number is returned
+
+    Returns bytes
+    """
+    if size is None:
+        size = max(1, (num.bit_length() + 7) // 8)
+    return binascii.unhexlify("%0*x" % (size * 2, num))
+
+
+def key_size(n):
+    """Returns the size of the RSA key (modulus) in bytes. This is the size
+    of every RSA block encrypted or decrypted with it.
+
+    Args:
+        n (int): the modulus
 
     Returns int
     """
-    # convert the string to hexadecimal
-    num_hex = "%x" % num
-    if len(num_hex) % 2 != 0:
-        num_hex = "0" + num_hex
+    return (n.bit_length() + 7) // 8
 
-    # Now, convert the hexadecimal form to a binary one.
 
-    if sys.version < '3':
-        chr_to_buf_f = bytearray
-    else:
-        chr_to_buf_f = bytes
+def modinv(a, m):
+    """Returns the modular multiplicative inverse of a modulo m.
+
+    >>> modinv(3, 11)
+    4
+
+    Args:
+        a (int): the number to be inverted
+        m (int): the modulus
+
+    Returns int
+    """
+    old_r, r = a % m, m
+    old_s, s = 1, 0
+    while r:
+        quotient = old_r // r
+        old_r, r = r, old_r - quotient * r
+        old_s, s = s, old_s - quotient * s
+    return old_s % m
+
+
+class RSAKeyring(object):
+    """A private RSA key with the Chinese Remainder Theorem parameters
+    precomputed, so that each decryption takes two exponentiations with
+    half-size exponents and moduli instead of a full one."""
+
+    def __init__(self, p, q, d):
+        """Create a RSAKeyring instance.
+
+        Args:
+            p (int): the first prime factor of the modulus
+            q (int): the second prime factor of the modulus
+            d (int): the private exponent
+        """
+        self.p = p
+        self.q = q
+        self.n = p * q
+        self.size = key_size(self.n)
+        self.dp = d % (p - 1)
+        self.dq = d % (q - 1)
+        self.qinv = modinv(q, p)
+
+    def decrypt_int(self, c):
+        """Decrypts a message represented as an integer.
+
+        Args:
+            c (int): the message to be decrypted
+
+        Returns int
+        """
+        m1 = pow(c % self.p, self.dp, self.p)
+        m2 = pow(c % self.q, self.dq, self.q)
+        h = (self.qinv * (m1 - m2)) % self.p
+        return m2 + h * self.q
+
+    def decrypt(self, c_bin):
+        """Decrypts an RSA block.
+
+        Args:
+            c_bin (bytearray): the message to be decrypted
 
-    num_bin = chr_to_buf_f()
+        Returns bytes (always as long as the key, leading zeros included)
+        """
+        return int_to_buf(self.decrypt_int(buf_to_int(c_bin)), self.size)
 
-    for i in range(int(len(num_hex)/2)):
-        chunk = num_hex[i*2:(i+1)*2]
-        num_bin += chr_to_buf_f([int(chunk, 16)])
 
-    return num_bin
+otserv_keyring = RSAKeyring(p, q, d)
 
 
 def RSA_decrypt(c_bin, n=otserv_n):
@@ -114,12 +183,14 @@ def RSA_decrypt(c_bin, n=otserv_n):
     Args:
         c_bin (bytearray): the message to be decrypted
 
-    Returns bytearray
+    Returns bytes (always as long as the key, leading zeros included)
     """
+    if n == otserv_keyring.n:
+        return otserv_keyring.decrypt(c_bin)
     c = buf_to_int(c_bin)
     # z = c^d % n. pow(c,d,n) is way faster than z = c**d % n.
     z = pow(c, d, n)
-    return int_to_buf(z)
+    return int_to_buf(z, key_size(n))
 
 
 def RSA_encrypt(m_bin, n=tibia_n, e=65537):
@@ -130,16 +201,18 @@ def RSA_encrypt(m_bin, n=tibia_n, e=65537):
         m_bin (bytearray): the message to be encrypted
         n (int): the public key used for encryption (default to real Tibia key)
 
-    Return bytearray
+    Return bytes (always as long as the key, leading zeros included)
     """
     # return c = m^e mod n
     m = buf_to_int(m_bin)
     c = pow(m, e, n)
-    return int_to_buf(c)
+    return int_to_buf(c, key_size(n))
 
 if __name__ == "__main__":
 
     if len(sys.argv) <= 1:
+        import doctest
+        doctest.testmod()
         sys.exit("Usage: RSA.py <filename> <optional offset>")
 
     # Switch stdout to binary mode so that Python 3 doesn't complain
@@ -152,13 +225,13 @@ if __name__ == "__main__":
         offset = int(sys.argv[2])
     decrypted = RSA_decrypt(buf[offset:offset+128])
 
-    if decrypted[17] != 0:
-        # Try to guess the offset. 17th byte is the second byte of
-        # account name size.
+    if decrypted[18] != 0:
+        # Try to guess the offset. 18th byte is the second byte of
+        # account name size (the block starts with a zero byte).
         for offset in range(len(buf)):
             decrypted = RSA_decrypt(buf[offset:offset+128])
             sys.stderr.write("Trying %d.\n" % offset)
-            if decrypted[17] == 0:
+            if decrypted[18] == 0:
                 sys.stderr.write("Try %d.\n" % offset)
                 break
     else:
@@ -0,0 +1,690 @@
+"""
+ReactorServer.py - runs the proxy in a single thread, driven by the readiness
+events of all of its sockets (epoll on Linux).
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import collections
+import errno
+import heapq
+import itertools
+import selectors
+import socket
+import time
+import traceback
+
+from tibiaproxy.ConnectionScheduler import WorkerPool
+from tibiaproxy.NetworkMessage import NetworkMessage
+from tibiaproxy.FrameReader import FrameReader
+from tibiaproxy.SendQueue import SendQueue
+from tibiaproxy.Server import Server, BOGUS_CHALLENGE
+from tibiaproxy import GameProtocol
+from tibiaproxy.util import log
+
+READ = selectors.EVENT_READ
+WRITE = selectors.EVENT_WRITE
+
+
+class Channel(object):
+    """A non-blocking socket of a session, along with the data that could not
+    be sent yet. Complete frames read from it are passed to the session's
+    onFrame method; a disconnect, to its onClose method.
+
+    The data sent to a channel is queued and the reactor flushes all of the
+    queues once it has handled a round of events, so that the frames that
+    arrived together leave together, in one sendmsg call."""
+
+    def __init__(self, reactor, sock, session, connecting=False):
+        """Create a Channel instance and register it with the reactor.
+
+        Args:
+            reactor (ReactorServer): the reactor
+            sock (socket): the socket, already made non-blocking
+            session (object): the session the socket belongs to
+            connecting (bool): whether a connect() is still in progress
+        """
+        self.reactor = reactor
+        self.sock = sock
+        self.session = session
+        self.connecting = connecting
+        self.reader = FrameReader(sock)
+        self.queue = SendQueue(sock)
+        self.closing = False
+        self.closed = False
+        # Cleared once the peer is done sending; see stopReading.
+        self.reading = True
+        self.events = READ | WRITE if connecting else READ
+        reactor.selector.register(sock, self.events, self.handleEvent)
+
+    @classmethod
+    def connect(cls, reactor, address, session):
+        """Starts connecting to the given address without waiting for the
+        connection to be established. Data sent in the meantime is queued.
+
+        Returns Channel
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise socket.error(err, "Could not connect to %s:%s" % address)
+        return cls(reactor, sock, session, connecting=True)
+
+    def setEvents(self, events):
+        """Changes the events the channel waits for. A channel waiting for
+        none is taken out of the selector."""
+        if not self.reading:
+            events &= ~READ
+        if events == self.events or self.closed:
+            return
+        selector = self.reactor.selector
+        if not events:
+            selector.unregister(self.sock)
+        elif not self.events:
+            selector.register(self.sock, events, self.handleEvent)
+        else:
+            selector.modify(self.sock, events, self.handleEvent)
+        self.events = events
+
+    def stopReading(self):
+        """Stops waiting for data from a peer that half-closed the
+        connection, which would otherwise be reported readable forever. The
+        channel can still be sent data.
+
+        Returns None
+        """
+        self.reading = False
+        self.setEvents(self.events)
+
+    def handleEvent(self, mask):
+        """Called by the reactor when the socket is ready.
+
+        Returns None
+        """
+        # An event from the same round may come after the channel was
+        # closed by another one's handler.
+        if self.closed:
+            return
+        try:
+            self.dispatch(mask)
+        except Exception as e:
+            # Only this session is lost, just like a crashed connection
+            # thread would be.
+            log("Closing a session after an error: %r" % e)
+            self.session.close()
+
+    def dispatch(self, mask):
+        """Reacts to the readiness of the socket.
+
+        Returns None
+        """
+        if mask & WRITE:
+            if self.connecting:
+                err = self.sock.getsockopt(socket.SOL_SOCKET,
+                                           socket.SO_ERROR)
+                if err != 0:
+                    log("Could not connect: %s" % errno.errorcode.get(err))
+                    self.session.onClose(self)
+                    return
+                self.connecting = False
+            self.flush()
+        if mask & READ and not self.closed:
+            self.receive()
+
+    def receive(self):
+        """Reads whatever is available and passes on the complete frames,
+        which are only valid until the end of the reactor's round.
+
+        Returns None
+        """
+        try:
+            frames = self.reader.readFrames()
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            frames = None
+        if frames is None:
+            self.session.onClose(self)
+            return
+        for frame in frames:
+            if self.closing or self.closed:
+                break
+            self.session.onFrame(self, frame)
+
+    def send(self, data):
+        """Queues the data, to be sent at the end of the reactor's round.
+
+        Args:
+            data (bytearray): the data to be sent
+
+        Returns int (the number of bytes queued)
+        """
+        if self.closed:
+            return 0
+        self.reactor.dirty.add(self)
+        return self.queue.send(data)
+
+    def flush(self):
+        """Sends the queued data, finishing a pending close once it is all
+        gone. Whatever the socket does not take is copied, since the frames
+        read in this round are about to be overwritten.
+
+        Returns None
+        """
+        if self.closed:
+            return
+        done = False
+        if not self.connecting:
+            try:
+                done = self.queue.flush()
+            except socket.error:
+                self.close(force=True)
+                self.session.onClose(self)
+                return
+        if done:
+            if self.closing:
+                self.close(force=True)
+            else:
+                self.setEvents(READ)
+        else:
+            self.queue.hold()
+            self.setEvents(WRITE if self.closing else READ | WRITE)
+
+    def close(self, force=False):
+        """Closes the socket once the queued data is sent, or right away.
+
+        Args:
+            force (bool): whether to drop the queued data
+
+        Returns None
+        """
+        if self.closed:
+            return
+        if len(self.queue) > 0 and not force:
+            self.closing = True
+            self.reactor.dirty.add(self)
+            return
+        self.closed = True
+        if self.events:
+            self.reactor.selector.unregister(self.sock)
+        self.sock.close()
+
+
+class LoginSession(object):
+    """A login connection: awaiting the client's request, then awaiting the
+    login server's reply. If a login server fails, the request is sent to
+    the next one."""
+
+    AWAITING_REQUEST = 0
+    AWAITING_REPLY = 1
+    # The reply is in; its routes are being recorded.
+    REWRITING = 2
+
+    def __init__(self, server, conn):
+        self.server = server
+        self.state = LoginSession.AWAITING_REQUEST
+        self.client = Channel(server, conn, self)
+        # Kept, since the client may be gone by the time the reply comes.
+        self.peer = conn.getpeername()[0]
+        self.upstream = None
+        self.xtea_key = None
+        self.request = None
+        # The login server (Upstream) the login is counted in with.
+        self.target = None
+        self.tried = []
+        self.started = None
+        server.callLater(server.handshake_timeout, self.onHandshakeTimeout)
+
+    def onHandshakeTimeout(self):
+        """Closes the session if the client has not sent its request yet.
+
+        Returns None
+        """
+        if self.state == LoginSession.AWAITING_REQUEST and \
+                not self.client.closed:
+            log("The login handshake timed out")
+            self.close()
+
+    def onUpstreamTimeout(self, target):
+        """Fails over to the next login server if target still has not
+        replied.
+
+        Args:
+            target (Upstream): the login server the timer was set for
+
+        Returns None
+        """
+        if target is self.target and \
+                self.state == LoginSession.AWAITING_REPLY:
+            log("Login server %s timed out." % target)
+            self.failOver()
+
+    def failOver(self):
+        """Gives up on the current login server and sends the request to
+        the next one, or closes the session if there is none left.
+
+        Returns None
+        """
+        self.server.upstreams.release(self.target, False)
+        self.target = None
+        self.upstream.close(force=True)
+        if self.connectUpstream():
+            self.upstream.send(self.request)
+            return
+        log("None of the login servers replied.")
+        self.close()
+
+    def connectUpstream(self):
+        """Moves on to the next login server, taking one of the pooled
+        connections to it or starting to connect.
+
+        Returns bool (False if there is no login server left to try)
+        """
+        server = self.server
+        while True:
+            self.target = server.upstreams.acquire(self.tried)
+            if self.target is None:
+                return False
+            self.tried += [self.target]
+            self.started = time.time()
+            sock = self.target.take()
+            if sock is not None:
+                sock.setblocking(False)
+                self.upstream = Channel(server, sock, self)
+            else:
+                log("Connecting to the login server %s..." % self.target)
+                try:
+                    self.upstream = Channel.connect(
+                        server, self.target.address, self)
+                except socket.error as e:
+                    log("Could not connect to the login server %s: %s" % (
+                        self.target, e))
+                    server.upstreams.release(self.target, False)
+                    continue
+            # The same timeout the other engines give the login servers.
+            server.callLater(server.upstreams.timeout,
+                             self.onUpstreamTimeout, self.target)
+            return True
+
+    def onFrame(self, channel, frame):
+        """Advances the session with a frame read from one of its channels.
+
+        Returns None
+        """
+        server = self.server
+        if self.state == LoginSession.AWAITING_REQUEST and \
+                channel is self.client:
+            # The connection is set up while the request is decrypted.
+            if not self.connectUpstream():
+                log("None of the login servers replied.")
+                self.close()
+                return
+            self.xtea_key, self.request = server.rewriteLoginRequest(
+                NetworkMessage(frame))
+            self.upstream.send(self.request)
+            self.state = LoginSession.AWAITING_REPLY
+        elif self.state == LoginSession.AWAITING_REPLY and \
+                channel is self.upstream:
+            server.upstreams.release(self.target, True,
+                                     time.time() - self.started)
+            self.target = None
+            self.state = LoginSession.REWRITING
+            self.upstream.close(force=True)
+            server.consultRoutes(server.rewriteLoginReply,
+                                 [bytearray(frame), self.xtea_key,
+                                  self.peer], self.onReply)
+
+    def onReply(self, reply):
+        """Sends the client the rewritten reply of the login server.
+
+        Returns None
+        """
+        if reply is not None:
+            self.client.send(reply)
+        self.close()
+
+    def onClose(self, channel):
+        """Called when one of the channels got disconnected."""
+        if channel is self.client and (
+                self.state == LoginSession.REWRITING or
+                self.target is not None and
+                self.state == LoginSession.AWAITING_REPLY):
+            # The request is out; the reply still gets its routes recorded,
+            # and sent if the client only half-closed.
+            self.client.stopReading()
+            return
+        if self.state == LoginSession.REWRITING:
+            return
+        if channel is self.upstream and self.target is not None and \
+                self.state == LoginSession.AWAITING_REPLY:
+            log("Login server %s disconnected." % self.target)
+            self.failOver()
+            return
+        self.close()
+
+    def close(self):
+        """Closes both channels, letting the client get its reply first."""
+        self.client.close()
+        if self.upstream is not None:
+            self.upstream.close(force=True)
+        if self.target is not None:
+            self.server.upstreams.release(self.target)
+            self.target = None
+
+
+class GameSession(object):
+    """A game connection. It goes through three states: awaiting the
+    client's first message (after the bogus challenge was sent), awaiting the
+    game server's challenge (after connecting to it) and relaying.
+
+    If the client's address just logged in, a speculative connection to the
+    game server it most likely enters is opened during the first state; what
+    it sends is kept until the guess is confirmed or thrown away."""
+
+    AWAITING_FIRST_MESSAGE = 0
+    # The character's game server is being looked up.
+    AWAITING_ROUTE = 1
+    AWAITING_CHALLENGE = 2
+    RELAYING = 3
+
+    def __init__(self, server, conn):
+        self.server = server
+        self.state = GameSession.AWAITING_FIRST_MESSAGE
+        self.client = Channel(server, conn, self)
+        self.upstream = None
+        self.firstmsg_contents = None
+        self.relay = None
+        # Frames the client sent before the relay was set up.
+        self.early = []
+        self.guess = None
+        self.speculative = None
+        self.speculative_frames = []
+        self.client.send(BOGUS_CHALLENGE)
+        server.callLater(server.handshake_timeout, self.onHandshakeTimeout)
+        server.consultRoutes(server.routes.lookupPeer,
+                             [conn.getpeername()[0]], self.onGuess)
+
+    def onHandshakeTimeout(self):
+        """Closes the session if it is not relaying yet.
+
+        Returns None
+        """
+        if self.state != GameSession.RELAYING and not self.client.closed:
+            log("The game handshake timed out")
+            self.close()
+
+    def onGuess(self, guess):
+        """Opens the speculative connection, unless the client got ahead of
+        the lookup.
+
+        Returns None
+        """
+        if guess is None or self.client.closed or \
+                self.state != GameSession.AWAITING_FIRST_MESSAGE:
+            return
+        self.guess = guess
+        try:
+            self.speculative = Channel.connect(self.server, guess, self)
+        except socket.error:
+            pass
+
+    def onFrame(self, channel, frame):
+        """Advances the session with a frame read from one of its channels.
+
+        Returns None
+        """
+        server = self.server
+        if channel is self.speculative:
+            # The challenge (and whatever follows) of a game server we might
+            # not even need.
+            self.speculative_frames += [bytearray(frame)]
+        elif self.state == GameSession.RELAYING:
+            if channel is self.client:
+                if server.filterFrame(self.relay, "C", frame):
+                    self.upstream.send(frame)
+            elif server.filterFrame(self.relay, "S", frame):
+                self.client.send(frame)
+            # The packets the plugins injected go right behind the frame.
+            self.relay['connection'].flush()
+        elif channel is not self.client:
+            # The game server's challenge. Skip the size and the checksum.
+            self.upstream.send(server.answerChallenge(
+                self.firstmsg_contents, NetworkMessage(frame[6:])))
+            self.relay = server.newSession(self.client,
+                                           self.firstmsg_contents,
+                                           self.upstream, server.post)
+            self.state = GameSession.RELAYING
+            for early in self.early:
+                self.onFrame(self.client, early)
+            self.early = []
+        elif self.state == GameSession.AWAITING_FIRST_MESSAGE:
+            self.firstmsg_contents = GameProtocol.parseFirstMessage(
+                NetworkMessage(frame), server.handshake)
+            self.state = GameSession.AWAITING_ROUTE
+            server.consultRoutes(server.gameServerAddress,
+                                 [self.firstmsg_contents], self.onRoute)
+        else:
+            self.early += [bytearray(frame)]
+
+    def onRoute(self, address):
+        """Connects to the character's game server, or takes the speculative
+        connection if it goes there.
+
+        Returns None
+        """
+        if self.client.closed:
+            return
+        if address is None:
+            self.close()
+            return
+        self.state = GameSession.AWAITING_CHALLENGE
+        if self.speculative is not None and address == self.guess:
+            log("Using the connection to the game server (%s:%s) "
+                "opened in advance." % address)
+            self.upstream = self.speculative
+            self.speculative = None
+            for speculative_frame in self.speculative_frames:
+                self.onFrame(self.upstream, speculative_frame)
+            self.speculative_frames = []
+            return
+        self.dropSpeculative()
+        log("Connecting to the game server (%s:%s)." % address)
+        self.upstream = Channel.connect(self.server, address, self)
+
+    def onClose(self, channel):
+        """Called when one of the channels got disconnected."""
+        if channel is self.speculative:
+            # A failed guess costs nothing.
+            self.dropSpeculative()
+            return
+        log("The %s disconnected" % (
+            "client" if channel is self.client else "server"))
+        self.close()
+
+    def dropSpeculative(self):
+        """Throws the speculative connection away, if there is one."""
+        if self.speculative is not None:
+            self.speculative.close(force=True)
+            self.speculative = None
+        self.speculative_frames = []
+
+    def close(self):
+        """Closes both channels, letting each get what it was sent first."""
+        self.client.close()
+        if self.upstream is not None:
+            self.upstream.close()
+        self.dropSpeculative()
+
+
+class ReactorServer(Server):
+    """A Server that handles every connection in a single thread. The
+    listening sockets and all of the session sockets are registered with one
+    selector and each session is a state machine advanced by the frames its
+    sockets deliver, so there is no per-session thread nor select() call.
+
+    The RSA work of the handshakes is still done on the reactor's thread;
+    the lookups in a remote route store are not (see consultRoutes)."""
+
+    def run(self):
+        """Run the reactor forever.
+
+        Returns None
+        """
+        log(("Listening on address %s:%s (login), %s:%s (game), connections " +
+             "will be forwarded to %s:%s (reactor)") % (
+                 self.listen_login_host, self.listen_login_port,
+                 self.listen_game_host, self.listen_game_port,
+                 self.destination_login_host, self.destination_login_port))
+        self.selector = selectors.DefaultSelector()
+        self.upstreams.start()
+        # The channels that were sent something during the current round.
+        self.dirty = set()
+        # What the plugin threads hand back to the reactor, see post().
+        self.posted = collections.deque()
+        # [when, sequence number, func, args], the soonest first.
+        self.timers = []
+        self.timer_ids = itertools.count()
+        self.wakeup = socket.socketpair()
+        for sock in self.wakeup:
+            sock.setblocking(False)
+        self.selector.register(self.wakeup[0], READ, self.runPosted)
+        # The lookups in a remote route store, see consultRoutes().
+        self.route_pool = WorkerPool("route", self.handshake_threads,
+                                     self.max_queued, self.max_queue_wait)
+        for listener, session_class in [(self.l_s, LoginSession),
+                                        (self.g_s, GameSession)]:
+            listener.listen(self.listen_backlog)
+            listener.setblocking(False)
+            self.selector.register(listener, READ,
+                                   self.acceptor(listener, session_class))
+        try:
+            while True:
+                for key, mask in self.selector.select(self.nextTimeout()):
+                    key.data(mask)
+                self.runTimers()
+                self.flushChannels()
+        except (KeyboardInterrupt, SystemExit):
+            log("Received keyboard interrupt, quitting")
+
+    def callLater(self, delay, func, *args):
+        """Has the reactor call func(*args) in delay seconds. Only called on
+        the reactor's thread.
+
+        Returns None
+        """
+        heapq.heappush(self.timers, [time.time() + delay,
+                                     next(self.timer_ids), func, args])
+
+    def nextTimeout(self):
+        """Returns float (how long select() may wait for the next timer, in
+        seconds) or None if there are no timers"""
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - time.time())
+
+    def runTimers(self):
+        """Calls the functions whose time has come.
+
+        Returns None
+        """
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, func, args = heapq.heappop(self.timers)
+            try:
+                func(*args)
+            except Exception as e:
+                log("Error in a timer: %r" % e)
+
+    def post(self, func, *args):
+        """Has the reactor call func(*args) soon. May be called from any
+        thread.
+
+        Returns None
+        """
+        self.posted.append((func, args))
+        try:
+            self.wakeup[1].send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # The reactor has plenty of wakeups pending already.
+            pass
+
+    def runPosted(self, mask):
+        """Calls what was posted to the reactor.
+
+        Returns None
+        """
+        try:
+            self.wakeup[0].recv(4096)
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.posted:
+            func, args = self.posted.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                log("Error in a posted call: %r" % e)
+
+    def consultRoutes(self, func, args, done):
+        """Calls done(func(*args)), func being a function that consults the
+        routing table. If the routes are kept remotely, func runs on one of
+        the route threads and done is posted back to the reactor, so that a
+        slow route store does not stall it; done gets None if func failed or
+        could not be run in time.
+
+        Returns None
+        """
+        if not self.routes.isRemote():
+            done(func(*args))
+            return
+
+        def call():
+            try:
+                result = func(*args)
+            except Exception:
+                log(traceback.format_exc())
+                result = None
+            self.post(done, result)
+        self.route_pool.submit(call, [], lambda: self.post(done, None))
+
+    def flushChannels(self):
+        """Flushes the queues of the channels sent something this round.
+
+        Returns None
+        """
+        while self.dirty:
+            dirty = self.dirty
+            self.dirty = set()
+            for channel in dirty:
+                channel.flush()
+
+    def acceptor(self, listener, session_class):
+        """Returns function (the readiness handler of a listening socket,
+        starting a session_class session for each new connection)"""
+        def accept(mask):
+            while True:
+                try:
+                    conn, addr = listener.accept()
+                except (BlockingIOError, InterruptedError):
+                    return
+                log("Received a %s connection from %s:%s" % (
+                    "login" if session_class is LoginSession else "game",
+                    addr[0], addr[1]))
+                conn.setblocking(False)
+                session_class(self, conn)
+        return accept
@@ -0,0 +1,462 @@
+"""
+RoutingTable.py - remembers which game server each character logged in to,
+for a limited time and up to a limited number of characters.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import collections
+import contextlib
+import hmac
+import mmap
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from tibiaproxy.util import log
+
+
+class RoutingTable(object):
+    """Maps the character names to the addresses of their game servers. The
+    entries expire after ttl seconds and the backend evicts the least
+    recently used ones once it is full.
+
+    >>> routes = RoutingTable(MemoryBackend(capacity=2))
+    >>> routes.add('Knight', '10.0.0.1', 7172)
+    >>> routes.add('Druid', '10.0.0.2', 7172)
+    >>> routes.lookup('Knight')
+    ('10.0.0.1', 7172)
+    >>> routes.add('Sorcerer', '10.0.0.3', 7172)
+    >>> routes.lookup('Druid') is None
+    True
+    """
+
+    def __init__(self, backend=None, ttl=3600):
+        """Create a RoutingTable instance.
+
+        Args:
+            backend (object): where the routes are kept; MemoryBackend,
+                MmapBackend or SocketBackend. Defaults to a MemoryBackend.
+            ttl (int): how long a route is kept, in seconds
+        """
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+
+    def add(self, name, host, port):
+        """Remembers the game server of a character.
+
+        Args:
+            name (str): the character's name
+            host (str): the game server's address
+            port (int): the game server's port
+
+        Returns None
+        """
+        self.backend.put(name, (host, int(port)), self.ttl)
+
+    def lookup(self, name):
+        """Returns tuple (host, port) or None if the character is unknown"""
+        return self.backend.get(name)
+
+    # The game connection follows the login within seconds, so the guesses
+    # below need not be kept for long.
+    PEER_TTL = 300
+
+    def addPeer(self, ip, host, port):
+        """Remembers the game server a client is most likely to enter next.
+        Kept along with the characters, under a key no character name can
+        have.
+
+        Args:
+            ip (str): the client's address
+            host (str): the game server's address
+            port (int): the game server's port
+
+        Returns None
+        """
+        self.backend.put('@' + ip, (host, int(port)),
+                         min(self.ttl, self.PEER_TTL))
+
+    def lookupPeer(self, ip):
+        """Returns tuple (host, port) or None if there is no guess for ip"""
+        return self.backend.get('@' + ip)
+
+    def isRemote(self):
+        """Returns bool (whether the routes are kept in another process, so
+        that consulting them means waiting for the network)"""
+        return self.backend.remote
+
+
+class MemoryBackend(object):
+    """Keeps the routes in a dictionary of this process, in the order they
+    were last used.
+
+    >>> backend = MemoryBackend()
+    >>> backend.put('Knight', ('10.0.0.1', 7172), ttl=-1)
+    >>> backend.get('Knight') is None
+    True
+    """
+
+    remote = False
+
+    def __init__(self, capacity=10000):
+        """Create a MemoryBackend instance.
+
+        Args:
+            capacity (int): the most routes kept
+        """
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, name, route, ttl):
+        """Stores a route for ttl seconds, evicting the least recently used
+        ones if there are too many.
+
+        Returns None
+        """
+        now = time.time()
+        with self.lock:
+            self.entries.pop(name, None)
+            self.entries[name] = (route, now + ttl)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            # Drop the stale routes nobody asked for.
+            while self.entries:
+                oldest = next(iter(self.entries))
+                if self.entries[oldest][1] >= now:
+                    break
+                del self.entries[oldest]
+
+    def get(self, name):
+        """Returns tuple (the route) or None if it is unknown or expired"""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self.entries[name]
+                return None
+            self.entries.move_to_end(name)
+            return entry[0]
+
+
+# used, expires, last used, name, host, port
+_SLOT = struct.Struct("<Bdd32s64sH")
+_LAST_USED = struct.Struct("<d")
+_LAST_USED_OFFSET = 9
+
+
+class MmapBackend(object):
+    """Keeps the routes in a fixed-size hash table in shared memory: an
+    anonymous mapping shared with the processes forked afterwards, or a file
+    that any process on the machine can map. Each name has a few slots it
+    can go to; when all of them hold live routes, the least recently used
+    one is overwritten. Names longer than 32 bytes and host names longer
+    than 64 bytes are not stored.
+
+    >>> backend = MmapBackend(capacity=4)
+    >>> backend.put('Knight', ('10.0.0.1', 7172), ttl=60)
+    >>> backend.get('Knight')
+    ('10.0.0.1', 7172)
+    >>> backend.get('Druid') is None
+    True
+    """
+
+    remote = False
+
+    # The number of slots a name may occupy.
+    PROBES = 8
+
+    def __init__(self, capacity=10000, path=None):
+        """Create an MmapBackend instance.
+
+        Args:
+            capacity (int): the most routes kept; the table takes about
+                230 bytes per route
+            path (str): the file to map; by default, the memory is anonymous
+                and only shared with forked processes
+        """
+        self.slots = max(self.PROBES, 2 * capacity)
+        length = self.slots * _SLOT.size
+        self.fd = None
+        if path is None:
+            self.map = mmap.mmap(-1, length)
+            # Only there to be locked; see locked().
+            self.lock_file = tempfile.TemporaryFile()
+            self.fd = self.lock_file.fileno()
+        else:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self.fd).st_size < length:
+                os.ftruncate(self.fd, length)
+            self.map = mmap.mmap(self.fd, length)
+        self.thread_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Excludes the other threads and processes using the table. The
+        processes lock the file, with a record lock: it belongs to the
+        process rather than to the file descriptor the forked processes
+        share, and the kernel releases it if the process gets killed while
+        holding it."""
+        with self.thread_lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def offsets(self, key):
+        """Returns list (the offsets of the slots the key may occupy)"""
+        first = zlib.crc32(key) & 0xFFFFFFFF
+        return [((first + i) % self.slots) * _SLOT.size
+                for i in range(self.PROBES)]
+
+    def put(self, name, route, ttl):
+        """Stores a route for ttl seconds.
+
+        Returns None
+        """
+        key = name.encode('utf-8')
+        host = route[0].encode('utf-8')
+        if len(key) > 32 or len(host) > 64:
+            log("Cannot store the route of %s in shared memory" % name)
+            return
+        now = time.time()
+        with self.locked():
+            chosen = None
+            oldest = None
+            for offset in self.offsets(key):
+                used, expires, last_used, slot_key, _, _ = \
+                    _SLOT.unpack_from(self.map, offset)
+                if used and slot_key.rstrip(b'\0') == key:
+                    chosen = offset
+                    break
+                if not used or expires < now:
+                    if chosen is None:
+                        chosen = offset
+                elif oldest is None or last_used < oldest[0]:
+                    oldest = (last_used, offset)
+            if chosen is None:
+                chosen = oldest[1]
+            _SLOT.pack_into(self.map, chosen, 1, now + ttl, now, key, host,
+                            route[1])
+
+    def get(self, name):
+        """Returns tuple (the route) or None if it is unknown or expired"""
+        key = name.encode('utf-8')
+        if len(key) > 32:
+            return None
+        now = time.time()
+        with self.locked():
+            for offset in self.offsets(key):
+                used, expires, _, slot_key, host, port = \
+                    _SLOT.unpack_from(self.map, offset)
+                if used and expires >= now and slot_key.rstrip(b'\0') == key:
+                    _LAST_USED.pack_into(self.map, offset + _LAST_USED_OFFSET,
+                                         now)
+                    return host.rstrip(b'\0').decode('utf-8'), port
+        return None
+
+
+class SocketBackend(object):
+    """Keeps the routes in a route store shared by several proxy nodes, which
+    is run with python -m tibiaproxy.RoutingTable host:port. Each thread has
+    its own connection to the store, which it opens with the shared secret
+    if the store requires one. If the store cannot be reached, or takes
+    longer than timeout seconds to answer, the routes are not stored and
+    lookups fail."""
+
+    remote = True
+
+    def __init__(self, address, timeout=1.0, secret=None):
+        """Create a SocketBackend instance.
+
+        Args:
+            address (tuple): the host and port of the route store
+            timeout (float): how long to wait for the store, in seconds
+            secret (str): the store's shared secret, if it has one
+        """
+        self.address = address
+        self.timeout = timeout
+        self.secret = secret
+        self.local = threading.local()
+
+    def request(self, line):
+        """Sends a request line to the store and reads the reply line,
+        reconnecting once if the connection broke.
+
+        Returns str or None if the store cannot be reached
+        """
+        for _ in range(2):
+            try:
+                if getattr(self.local, 'stream', None) is None:
+                    conn = socket.create_connection(self.address,
+                                                    self.timeout)
+                    self.local.stream = conn.makefile('rwb')
+                    conn.close()
+                    if self.secret is not None:
+                        self.local.stream.write(
+                            b'AUTH\t' + self.secret.encode('utf-8') + b'\n')
+                self.local.stream.write(line.encode('utf-8') + b'\n')
+                self.local.stream.flush()
+                reply = self.local.stream.readline()
+                if reply:
+                    return reply.decode('utf-8').rstrip('\n')
+            except socket.error as e:
+                log("Route store error: %s" % e)
+            self.local.stream = None
+        return None
+
+    def put(self, name, route, ttl):
+        """Stores a route for ttl seconds.
+
+        Returns None
+        """
+        self.request("PUT\t%s\t%s\t%s\t%s" % (name, route[0], route[1], ttl))
+
+    def get(self, name):
+        """Returns tuple (the route) or None if it is unknown or expired"""
+        reply = self.request("GET\t%s" % name)
+        if not reply:
+            return None
+        host, port = reply.split("\t")
+        return host, int(port)
+
+
+class RouteStoreHandler(socketserver.StreamRequestHandler):
+    """Answers the requests of one SocketBackend connection. If the store
+    has a secret, the connection is dropped unless its first line is
+    AUTH followed by the secret."""
+
+    def handle(self):
+        backend = self.server.backend
+        secret = self.server.secret
+        if secret is not None:
+            fields = self.rfile.readline().rstrip(b'\n').split(b"\t", 1)
+            if len(fields) != 2 or fields[0] != b"AUTH" or \
+                    not hmac.compare_digest(fields[1],
+                                            secret.encode('utf-8')):
+                log("Refused a route store client from %s:%s" %
+                    self.client_address[:2])
+                return
+        for line in self.rfile:
+            fields = line.decode('utf-8').rstrip('\n').split("\t")
+            if fields[0] == "PUT" and len(fields) == 5:
+                backend.put(fields[1], (fields[2], int(fields[3])),
+                            float(fields[4]))
+                reply = "OK"
+            elif fields[0] == "GET" and len(fields) == 2:
+                route = backend.get(fields[1])
+                reply = "" if route is None else "%s\t%s" % route
+            else:
+                reply = ""
+            self.wfile.write(reply.encode('utf-8') + b'\n')
+
+
+class RouteStore(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """The route store SocketBackend talks to, keeping the routes in a
+    MemoryBackend. Whoever can store routes in it decides where the players
+    go to log in, and take their passwords along, so it should only be
+    reachable by the proxies: on the loopback interface, or with a secret.
+
+    >>> store = RouteStore(('127.0.0.1', 0), secret='s3cret')
+    >>> threading.Thread(target=store.serve_forever, daemon=True).start()
+    >>> SocketBackend(store.server_address, secret='s3cret').put(
+    ...     'Knight', ('10.0.0.1', 7172), 60)
+    >>> SocketBackend(store.server_address, secret='guess').put(
+    ...     'Knight', ('6.6.6.6', 7172), 60)
+    >>> SocketBackend(store.server_address, secret='s3cret').get('Knight')
+    ('10.0.0.1', 7172)
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, capacity=100000, secret=None):
+        """Create a RouteStore instance, listening on address.
+
+        Args:
+            address (tuple): the host and port to listen on
+            capacity (int): the most routes kept
+            secret (str): the secret the clients have to send first, or None
+                to let anyone in
+        """
+        socketserver.TCPServer.__init__(self, address, RouteStoreHandler)
+        self.backend = MemoryBackend(capacity)
+        self.secret = secret
+
+
+def openRoutingTable(store=None, ttl=3600, capacity=10000, shared=False,
+                     secret=None):
+    """Creates the routing table described by the configuration.
+
+    Args:
+        store (str): None to keep the routes in this process (or in shared
+            memory), a file path for a memory-mapped file or "host:port" for
+            a route store
+        ttl (int): how long a route is kept, in seconds
+        capacity (int): the most routes kept
+        shared (bool): whether worker processes will be forked that need to
+            see the same routes
+        secret (str): the route store's shared secret, if it has one
+
+    Returns RoutingTable
+    """
+    if store is None:
+        if shared:
+            backend = MmapBackend(capacity)
+        else:
+            backend = MemoryBackend(capacity)
+    elif ':' in store and os.sep not in store:
+        host, port = store.rsplit(':', 1)
+        backend = SocketBackend((host, int(port)), secret=secret)
+    else:
+        backend = MmapBackend(capacity, path=store)
+    return RoutingTable(backend, ttl)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # Only the local proxies get in, unless told otherwise.
+        host, _, port = sys.argv[1].rpartition(':')
+        host = host or '127.0.0.1'
+        secret = os.environ.get('TIBIAPROXY_ROUTE_SECRET') or None
+        if secret is None and not host.startswith('127.') and \
+                host != 'localhost':
+            sys.exit("Set TIBIAPROXY_ROUTE_SECRET to serve routes on %s; "
+                     "anyone who can store a route can hijack logins" %
+                     host)
+        log("Serving routes on %s:%s" % (host, port))
+        RouteStore((host, int(port)), secret=secret).serve_forever()
+    else:
+        import doctest
+        doctest.testmod()
@@ -0,0 +1,174 @@
+"""
+Sandbox.py - evaluates untrusted Python expressions in a separate, confined
+process with limited CPU time and memory.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import ast
+import os
+import signal
+import subprocess
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+try:
+    import pwd
+except ImportError:
+    pwd = None
+
+# All the expression can call. None of these reach the file system, the
+# other modules or the interpreter's internals.
+SAFE_BUILTINS = dict((name, getattr(builtins, name)) for name in [
+    'abs', 'all', 'any', 'bin', 'bool', 'bytearray', 'bytes', 'chr', 'dict',
+    'divmod', 'enumerate', 'filter', 'float', 'hex', 'int', 'iter', 'len',
+    'list', 'map', 'max', 'min', 'oct', 'ord', 'pow', 'range', 'repr',
+    'reversed', 'round', 'set', 'sorted', 'str', 'sum', 'tuple', 'zip'])
+
+# The attributes leading from a generator or a traceback to the frames, and
+# from there to the globals of the process, and the string formatting, whose
+# fields reach attributes the parser never sees.
+FORBIDDEN_ATTRIBUTES = set(['gi_frame', 'gi_code', 'cr_frame', 'cr_code',
+                            'ag_frame', 'ag_code', 'tb_frame', 'f_back',
+                            'f_globals', 'f_locals', 'f_builtins', 'format',
+                            'format_map'])
+
+
+def evaluate(expression, cpu_seconds=1, memory=256 << 20, timeout=2.0):
+    """Evaluates an expression in a new Python process, which gets killed
+    once it used up cpu_seconds of CPU time, tries to allocate more than
+    memory bytes (where the resource module is available) or runs for more
+    than timeout seconds. Nothing from the proxy is visible to it.
+
+    The expression only gets the builtins in SAFE_BUILTINS and may not
+    touch the attributes starting with an underscore, nor the ones in
+    FORBIDDEN_ATTRIBUTES. On top of that, the process cannot open files nor
+    start processes, and gives up the root privileges if it has them.
+
+    >>> evaluate("6*7")
+    '42'
+    >>> evaluate("open('/etc/passwd')")
+    "name 'open' is not defined"
+    >>> evaluate("().__class__")
+    'forbidden attribute: __class__'
+    >>> evaluate("1/0")
+    'division by zero'
+    >>> evaluate("bytearray(1 << 30)")
+    'out of memory'
+    >>> evaluate("sum(range(10 ** 10))")
+    'out of CPU time'
+    >>> evaluate("[0 for _ in iter(int, 1)]", cpu_seconds=10, timeout=0.5)
+    'timed out'
+
+    Args:
+        expression (str): the Python expression
+        cpu_seconds (int): the CPU time limit, in seconds
+        memory (int): the address space limit, in bytes
+        timeout (float): the wall clock limit, in seconds
+
+    Returns str (the result or the error, as text)
+    """
+    # -I keeps the environment and the user's site-packages out.
+    args = [sys.executable, '-I', os.path.abspath(__file__),
+            str(cpu_seconds), str(memory)]
+    try:
+        child = subprocess.run(args, input=expression.encode('utf-8'),
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return 'timed out'
+    if child.returncode == -getattr(signal, 'SIGXCPU', 0):
+        return 'out of CPU time'
+    if child.returncode != 0:
+        return 'evaluation failed'
+    return child.stdout.decode('utf-8', 'replace')
+
+
+def _check(tree):
+    """Refuses the expressions reaching for the interpreter's internals.
+
+    Args:
+        tree (ast.AST): the parsed expression
+
+    Returns None
+    """
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and (
+                node.attr.startswith('_') or
+                node.attr in FORBIDDEN_ATTRIBUTES):
+            raise NameError("forbidden attribute: %s" % node.attr)
+        if isinstance(node, ast.Name) and node.id.startswith('__'):
+            raise NameError("forbidden name: %s" % node.id)
+
+
+def _confine(cpu_seconds, memory):
+    """Takes away what the sandboxed process does not need: the privileges,
+    the file descriptors beyond stdin, stdout and stderr, the child
+    processes and most of the CPU time and memory.
+
+    Returns None
+    """
+    if pwd is not None and os.getuid() == 0:
+        nobody = pwd.getpwnam('nobody')
+        os.setgroups([])
+        os.setgid(nobody.pw_gid)
+        os.setuid(nobody.pw_uid)
+    if resource is not None:
+        # SIGXCPU at the soft limit, so that the parent can tell why the
+        # process died; SIGKILL a second later.
+        resource.setrlimit(resource.RLIMIT_CPU,
+                           (cpu_seconds, cpu_seconds + 1))
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (3, 3))
+        resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+        resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+
+
+def _evaluateHere(cpu_seconds, memory):
+    """The body of the sandboxed process: reads the expression from stdin and
+    writes the result to stdout.
+
+    Returns None
+    """
+    _confine(cpu_seconds, memory)
+    expression = sys.stdin.read()
+    try:
+        tree = ast.parse(expression, mode='eval')
+        _check(tree)
+        result = str(eval(compile(tree, '<expression>', 'eval'),
+                          {'__builtins__': SAFE_BUILTINS}))
+    except MemoryError:
+        result = 'out of memory'
+    except Exception as e:
+        result = str(e)
+    sys.stdout.write(result)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        _evaluateHere(int(sys.argv[1]), int(sys.argv[2]))
+    else:
+        import doctest
+        doctest.testmod()
@@ -0,0 +1,140 @@
+"""
+SendQueue.py - collects the frames to be sent to a socket and writes them out
+together, with as few system calls as possible.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+
+class SendQueue(object):
+    """The outbound queue of a socket. Frames are queued without being copied
+    and flushed with a single sendmsg call over all of them; whatever part
+    the socket does not take stays queued, from the exact byte it stopped at.
+
+    Since the frames are not copied, they must stay valid until flush()
+    returns, or until hold() is called.
+
+    >>> import socket
+    >>> a, b = socket.socketpair()
+    >>> queue = SendQueue(a)
+    >>> queue.send(b'\\x01\\x00a')
+    3
+    >>> queue.send(bytearray(b'\\x02\\x00bc'))
+    4
+    >>> len(queue), queue.depth()
+    (2, 7)
+    >>> queue.flush()
+    True
+    >>> b.recv(16)
+    b'\\x01\\x00a\\x02\\x00bc'
+    >>> len(queue), queue.depth()
+    (0, 0)
+    """
+
+    def __init__(self, sock):
+        """Create a SendQueue instance.
+
+        Args:
+            sock (socket): the socket the frames are sent to
+        """
+        self.sock = sock
+        self.buffers = []
+        self.size = 0
+
+    def __len__(self):
+        """Returns int (the number of queued buffers)"""
+        return len(self.buffers)
+
+    def depth(self):
+        """Returns int (the number of queued bytes)"""
+        return self.size
+
+    def send(self, data):
+        """Queues the data. Named after socket.send, so that the queue can
+        stand in for the socket, e.g. in a Connection.
+
+        Args:
+            data (bytearray): the data to be sent
+
+        Returns int (the number of bytes queued)
+        """
+        if len(data) > 0:
+            self.buffers += [data]
+            self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        """Writes out the queue. On a blocking socket it returns once the
+        whole queue is sent; on a non-blocking one, as soon as the socket
+        stops taking data.
+
+        Returns bool (True if the queue is empty now)
+        """
+        while self.buffers:
+            try:
+                sent = self._write(self.buffers[:IOV_MAX])
+            except (BlockingIOError, InterruptedError):
+                return False
+            self._consume(sent)
+            if self.buffers and self.sock.gettimeout() == 0.0:
+                # The socket took what it could; wait for it to be writable.
+                return False
+        return True
+
+    def _write(self, buffers):
+        """Writes as much of the buffers as the socket takes.
+
+        Returns int (the number of bytes written)
+        """
+        if hasattr(self.sock, 'sendmsg'):
+            return self.sock.sendmsg(buffers)
+        return self.sock.send(b''.join(buffers))
+
+    def _consume(self, sent):
+        """Drops the first sent bytes from the queue.
+
+        Returns None
+        """
+        self.size -= sent
+        done = 0
+        while done < len(self.buffers) and sent >= len(self.buffers[done]):
+            sent -= len(self.buffers[done])
+            done += 1
+        del self.buffers[:done]
+        if sent > 0:
+            self.buffers[0] = memoryview(self.buffers[0])[sent:]
+
+    def hold(self):
+        """Copies whatever is still queued, for when the queued buffers are
+        about to be reused by their owners.
+
+        Returns None
+        """
+        if len(self.buffers) > 1 or (self.buffers and
+                                     not isinstance(self.buffers[0], bytes)):
+            self.buffers = [b''.join(self.buffers)]
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
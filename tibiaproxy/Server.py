@@ -17,14 +17,28 @@
 #along with Foobar; if not, write to the Free Software
 #Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
-from tibiaproxy.NetworkMessage import NetworkMessage, adlerChecksum
+from tibiaproxy.NetworkMessage import NetworkMessage, OutputMessage
+from tibiaproxy.NetworkMessage import MessagePool
+from tibiaproxy.NetworkMessage import adlerChecksum
+from tibiaproxy.FrameCodec import FrameCodec
 from tibiaproxy import LoginProtocol
 from tibiaproxy import GameProtocol
 from tibiaproxy import XTEA
-from tibiaproxy import RSA
-from tibiaproxy.util import log, assert_equal
-
-import select
+from tibiaproxy.HandshakeService import HandshakeService
+from tibiaproxy.Plugins import PluginRegistry
+from tibiaproxy.ConnectionScheduler import ConnectionScheduler
+from tibiaproxy.RoutingTable import RoutingTable
+from tibiaproxy.FrameReader import FrameReader
+from tibiaproxy.Passthrough import Passthrough
+from tibiaproxy.Preconnect import Preconnect
+from tibiaproxy.SendQueue import SendQueue
+from tibiaproxy.UpstreamGroup import Upstream, UpstreamGroup
+from tibiaproxy.UpstreamGroup import UpstreamRequest
+from tibiaproxy.PluginExecutor import PluginExecutor
+from tibiaproxy.util import log
+
+import collections
+import selectors
 import socket
 import copy
 import time
@@ -32,29 +46,145 @@ import threading
 import sys
 import struct
 
+# A bogus challenge = 109, timestamp = 1385139009
+BOGUS_CHALLENGE = b'\x0c\x00@\x02!\x07\x06\x00\x1fA\x8b\x8fRm'
+
 
 class Connection(object):
     """Exposes an interface that allows the plugins to perform protocol
-    operations"""
+    operations. The packets the plugins inject are queued and the server
+    sends them by calling flush() once it has relayed a batch of frames, all
+    of the packets queued for one side packed into a single frame.
+
+    >>> sent = {'client': [], 'server': []}
+    >>> class Side(object):
+    ...     def __init__(self, name):
+    ...         self.name = name
+    ...     def send(self, data):
+    ...         sent[self.name].append(bytes(data))
+    >>> key = [1, 2, 3, 4]
+    >>> conn = Connection(Side('client'), XTEA.XTEACipher(key),
+    ...                   Side('server'))
+    >>> for msg in ['one', 'two', 'three']:
+    ...     conn.client_send_said({'name': 'a', 'level': 1}, [1, 2, 3], msg)
+    >>> sent['client']
+    []
+    >>> conn.flush()
+    >>> len(sent['client']), len(sent['server'])
+    (1, 0)
+    >>> frame = FrameCodec(key).decode(bytearray(sent['client'][0]))
+    >>> [packet['message'] for _, packet in GameProtocol.iterPackets(
+    ...     NetworkMessage(frame), GameProtocol.server_packet_parsers)]
+    ['one', 'two', 'three']
+    """
+
+    # Once the packets queued for a side take more than that many bytes,
+    # the next ones go to another frame, keeping well below the size of the
+    # client's receive buffer.
+    MAX_FRAME_PAYLOAD = 16384
+
+    def __init__(self, conn, cipher, server_conn):
+        """Create a Connection instance.
 
-    def __init__(self, conn, xtea_key):
+        Args:
+            conn (object): the player's connection; anything with a send
+                method
+            cipher (XTEACipher): the session's cipher
+            server_conn (object): the game server's connection, the same
+        """
         self.conn = conn
-        self.xtea_key = xtea_key
+        self.server_conn = server_conn
+        self.cipher = cipher
+        # The packets being packed (OutputMessage) and the frames already
+        # full, for each side. The hooks may run on other threads than the
+        # relay.
+        self.pending = {'client': None, 'server': None}
+        self.frames = {'client': [], 'server': []}
+        self.lock = threading.Lock()
+
+    def client_send_packet(self, packet):
+        """Queues a server packet for the player.
+
+        Args:
+            packet (dict): the packet's fields, along with its packet_type
+
+        Returns None
+        """
+        self.queuePacket('client', packet,
+                         GameProtocol.server_packet_builders)
+
+    def server_send_packet(self, packet):
+        """Queues a client packet for the game server.
+
+        Args:
+            packet (dict): the packet's fields, along with its packet_type
+
+        Returns None
+        """
+        self.queuePacket('server', packet,
+                         GameProtocol.client_packet_builders)
 
     def client_send_said(self, player, pos, msg):
-        sendmsg = NetworkMessage()
-        sendmsg.addByte(0xAA)
-        sendmsg.addU32(3)  # statement ID
-        sendmsg.addString("1")
-        sendmsg.addU16(1)  # level
-        sendmsg.addByte(1)  # type: SPEAK_SAY
         assert(len(pos) == 3)
-        sendmsg.addU16(pos[0])
-        sendmsg.addU16(pos[1])
-        sendmsg.addByte(pos[2])
-        sendmsg.writable = True  # FIXME
-        sendmsg.addString(msg)
-        self.conn.send(sendmsg.getEncrypted(self.xtea_key))
+        self.client_send_packet({'packet_type': 0xAA,
+                                 'statement_id': 3,
+                                 'name': player['name'],
+                                 'level': player['level'],
+                                 'speak_type': 1,  # SPEAK_SAY
+                                 'position': pos,
+                                 'message': msg})
+
+    def queuePacket(self, side, packet, builders):
+        """Adds a packet to the frame being packed for a side.
+
+        Args:
+            side (str): "client" or "server"
+            packet (dict): the packet's fields, along with its packet_type
+            builders (dict): client_packet_builders or server_packet_builders
+
+        Returns None
+        """
+        with self.lock:
+            msg = self.pending[side]
+            if msg is None:
+                msg = self.pending[side] = OutputMessage()
+            GameProtocol.buildPacket(msg, packet, builders)
+            if msg.end - msg.start > self.MAX_FRAME_PAYLOAD:
+                self.frames[side] += [msg.getEncrypted(self.cipher)]
+                self.pending[side] = None
+
+    def flush(self):
+        """Sends the queued packets. Only called by the relay.
+
+        Returns None
+        """
+        for side, conn in [('client', self.conn),
+                           ('server', self.server_conn)]:
+            with self.lock:
+                msg = self.pending[side]
+                if msg is not None:
+                    self.frames[side] += [msg.getEncrypted(self.cipher)]
+                    self.pending[side] = None
+                frames = self.frames[side]
+                self.frames[side] = []
+            for frame in frames:
+                conn.send(frame)
+
+    def forward(self, direction, frame):
+        """Sends a relayed frame on to the other side. Only called by the
+        relay.
+
+        Args:
+            direction (str): "C" for the client's frames, "S" for the
+                server's
+            frame (bytes): the whole frame
+
+        Returns None
+        """
+        if direction == "C":
+            self.server_conn.send(frame)
+        else:
+            self.conn.send(frame)
 
 
 class Server:
@@ -64,7 +194,12 @@ class Server:
     def __init__(self, destination_login_host, destination_login_port,
                  listen_login_host, listen_login_port,
                  listen_game_host, listen_game_port,
-                 announce_host, announce_port, real_tibia, debug, plugins):
+                 announce_host, announce_port, real_tibia, debug, plugins,
+                 handshake_workers=0, verify_checksums=True,
+                 reuse_port=False, routes=None, listen_backlog=128,
+                 handshake_threads=16, relay_threads=1000, max_queued=256,
+                 max_queue_wait=5.0, upstreams=None, plugin_threads=0,
+                 plugin_timeout=3.0, handshake_timeout=10.0):
         self.destination_login_host = destination_login_host
         self.destination_login_port = int(destination_login_port)
         self.listen_login_host = listen_login_host
@@ -76,18 +211,57 @@ class Server:
         self.real_tibia = real_tibia
         self.debug = debug
         self.plugins = plugins
+        self.registry = PluginRegistry(plugins)
+        self.wanted = {'C': self.registry.opcodes('C'),
+                       'S': self.registry.opcodes('S')}
+        self.handshake = HandshakeService(handshake_workers)
+        # With plugin threads, the hooks run away from the relay, which
+        # forwards or drops the frames once they are done.
+        self.plugin_executor = None
+        if plugin_threads > 0 and (self.registry.subscribed("C") or
+                                   self.registry.subscribed("S")):
+            self.plugin_executor = PluginExecutor(plugin_threads,
+                                                  plugin_timeout)
+        self.verify_checksums = verify_checksums
+        self.listen_backlog = listen_backlog
+        self.handshake_threads = handshake_threads
+        self.relay_threads = relay_threads
+        self.max_queued = max_queued
+        self.max_queue_wait = max_queue_wait
+        self.handshake_timeout = handshake_timeout
+        self.scheduler = None
+        # The login servers the logins are spread between; their probes and
+        # connection pools are started by run().
+        if upstreams is None:
+            upstreams = UpstreamGroup([Upstream(
+                (self.destination_login_host, self.destination_login_port))])
+        self.upstreams = upstreams
 
         # Try to request the TCP port from the operating system. Tell it that
         # it is going to be a reusable port, so that a sudden crash of the
         # program is not going to block the port forever for other processes.
-        self.l_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.l_s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.l_s.bind((self.listen_login_host, self.listen_login_port))
-
-        self.g_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.g_s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.g_s.bind((self.listen_game_host, self.listen_game_port))
-        self.characters = {}
+        # With reuse_port, several processes can listen on the same ports,
+        # the kernel spreading the connections between them.
+        self.l_s = self.bindSocket(self.listen_login_host,
+                                   self.listen_login_port, reuse_port)
+        self.g_s = self.bindSocket(self.listen_game_host,
+                                   self.listen_game_port, reuse_port)
+        # Which game server each character logged in to; filled in on login
+        # and read on the game handshake. May be shared between the worker
+        # processes and proxy nodes.
+        self.routes = routes if routes is not None else RoutingTable()
+
+    def bindSocket(self, host, port, reuse_port=False):
+        """Creates a TCP socket bound to the given address.
+
+        Returns socket
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind((host, port))
+        return s
 
     def handleLogin(self, conn, msg):
         """Handles the login communication, passing it to the destination host,
@@ -100,42 +274,80 @@ class Server:
 
         Returns None
         """
-        xtea_key = LoginProtocol.parseFirstMessage(msg)
-
-        # Connect to the destination host, send the request and read the reply.
-        dest_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        log("Connecting to the destination host...")
-        dest_s.connect((self.destination_login_host,
-                        self.destination_login_port))
-        if not self.real_tibia:
-            dest_s.send(msg.getRaw())
-        else:
-            reencrypted = RSA.RSA_encrypt(RSA.RSA_decrypt(msg.getRaw()[28:]))
-            unencrypted = msg.getRaw()[6:28]
-            new_buf = ""
-            new_buf += msg.getRaw()[:2]
-            new_buf += struct.pack("<I",
-                                   adlerChecksum(unencrypted+reencrypted))
-            new_buf += unencrypted
-            new_buf += reencrypted
-            dest_s.send(new_buf)
-        data = dest_s.recv(1024)
-        if data == '':
-            log("Server disconnected.")
+        # Get the connection to the login server going first, so that
+        # connecting overlaps with decrypting the request.
+        upstream_request = UpstreamRequest(self.upstreams)
+        try:
+            xtea_key, request = self.rewriteLoginRequest(msg)
+        except Exception:
+            upstream_request.cancel()
+            raise
+
+        # Send the request and read the reply, failing over to the other
+        # login servers if need be.
+        data = upstream_request.send(request)
+        if data is None:
+            log("None of the login servers replied.")
             conn.close()
             return
+        # Send the message and close the connection.
+        conn.send(self.rewriteLoginReply(data, xtea_key,
+                                         conn.getpeername()[0]))
+        conn.close()
+
+    def rewriteLoginRequest(self, msg):
+        """Reads the XTEA key from the client's login request and prepares the
+        request to be passed to the destination host.
+
+        Args:
+            msg (NetworkMessage): the first message received.
+
+        Returns tuple (the XTEA key and the request to be sent)
+        """
+        xtea_key = LoginProtocol.parseFirstMessage(msg, self.handshake)
+        if not self.real_tibia:
+            return xtea_key, msg.getRaw()
+        reencrypted = self.handshake.encrypt(
+            self.handshake.decrypt(msg.getRaw()[28:156]))
+        unencrypted = msg.getRaw()[6:28]
+        new_buf = bytearray()
+        new_buf += msg.getRaw()[:2]
+        new_buf += struct.pack("<I",
+                               adlerChecksum(unencrypted+reencrypted))
+        new_buf += unencrypted
+        new_buf += reencrypted
+        return xtea_key, new_buf
+
+    def rewriteLoginReply(self, data, xtea_key, peer=None):
+        """Remembers the characters from the login server's reply and points
+        their worlds to the proxy.
+
+        Args:
+            data (bytes): the raw reply of the login server
+            xtea_key (list): the session's XTEA key
+            peer (str): the client's address, remembered along with the game
+                server it is most likely to enter
+
+        Returns bytearray (the reply to be sent to the client)
+        """
         msg = NetworkMessage(data)
         reply = LoginProtocol.parseReply(msg, xtea_key)
         if reply is None:
             # The reply doesn't seem to contain character list - just forward
             # it.
             log("WARNING: Passing through the login request.")
-            conn.send(data)
-            conn.close()
-            return
+            return data
 
         for character in reply['characters']:
-            self.characters[character['name']] = character
+            self.routes.add(character['name'],
+                            character['world']['hostname'],
+                            character['world']['port'])
+        if peer is not None and reply['characters']:
+            # The world most of the characters are on.
+            worlds = [(c['world']['hostname'], c['world']['port'])
+                      for c in reply['characters']]
+            host, port = max(worlds, key=worlds.count)
+            self.routes.addPeer(peer, host, port)
 
         # Replace the IP and port with the address to the proxy.
         client_reply = copy.deepcopy(reply)
@@ -143,9 +355,7 @@ class Server:
             world['hostname'] = self.announce_host
             world['port'] = self.announce_port
         client_reply_msg = LoginProtocol.prepareReply(client_reply)
-        # Send the message and close the connection.
-        conn.send(client_reply_msg.getEncrypted(xtea_key))
-        conn.close()
+        return client_reply_msg.getEncrypted(xtea_key)
 
     def handleGame(self, conn):
         """Connect to the game server, relay the packets between the the
@@ -161,192 +371,421 @@ class Server:
 
         Returns None
         """
+        session = self.gameHandshake(conn)
+        if session is not None:
+            self.runRelay(session)
 
-        # send a bogus challenge = 109, timestamp = 1385139009
-        conn.send(b'\x0c\x00@\x02!\x07\x06\x00\x1fA\x8b\x8fRm')
+    def gameHandshake(self, conn):
+        """The first part of handleGame: answers the client with a challenge,
+        connects to the game server and passes on the client's first message.
 
-        data = conn.recv(2)
-        size = struct.unpack("<H", data)[0]
-        data += conn.recv(size)
-        # Read the XTEA key from the player, pass on the original packet.
-        msg = NetworkMessage(data)
-        firstmsg_contents = GameProtocol.parseFirstMessage(msg)
-
-        # Connect to the game server.
-        dest_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        character = self.characters[firstmsg_contents['character_name']]
-        game_host = character['world']['hostname']
-        game_port = character['world']['port']
-        log("Connecting to the game server (%s:%s)." % (game_host, game_port))
-        dest_s.connect((game_host, game_port))
-        size_raw = dest_s.recv(2)
-        size = struct.unpack("<H", size_raw)[0]
-        checksum = dest_s.recv(4)
-        data = dest_s.recv(size - 4)
-        msg = NetworkMessage(data)
+        Args:
+            conn (socket): the player's connection
 
-        challenge_data = GameProtocol.parseChallengeMessage(msg)
+        Returns dict (the session, see relayGame) or None if the handshake
+            failed
+        """
+        # A client or game server that stalls only holds the handshake for
+        # so long.
+        conn.settimeout(self.handshake_timeout)
+        preconnect = None
+        dest_s = None
+        done = False
+        try:
+            # If this address just logged in, connect to the game server it
+            # most likely enters while the client is still answering the
+            # challenge.
+            guess = self.routes.lookupPeer(conn.getpeername()[0])
+            if guess is not None:
+                preconnect = Preconnect(guess)
+
+            conn.send(BOGUS_CHALLENGE)
+
+            client_reader = FrameReader(conn)
+            data = client_reader.readFrame()
+            if data is None:
+                log("The client disconnected")
+                return None
+            # Read the XTEA key from the player, pass on the original packet.
+            msg = NetworkMessage(data)
+            firstmsg_contents = GameProtocol.parseFirstMessage(
+                msg, self.handshake)
+
+            # Connect to the game server.
+            address = self.gameServerAddress(firstmsg_contents)
+            if preconnect is not None:
+                dest_s = preconnect.take(address, self.handshake_timeout)
+            if address is None:
+                return None
+            if dest_s is None:
+                log("Connecting to the game server (%s:%s)." % address)
+                dest_s = socket.create_connection(address,
+                                                  self.handshake_timeout)
+            else:
+                log("Using the connection to the game server (%s:%s) "
+                    "opened in advance." % address)
+            dest_s.settimeout(self.handshake_timeout)
+            server_reader = FrameReader(dest_s)
+            data = server_reader.readFrame()
+            if data is None:
+                log("The server disconnected")
+                return None
+            # Skip the size and the checksum.
+            msg = NetworkMessage(data[6:])
+
+            dest_s.send(self.answerChallenge(firstmsg_contents, msg))
+            done = True
+        except socket.error as e:
+            log("The game handshake failed: %s" % e)
+            return None
+        finally:
+            if not done:
+                if preconnect is not None:
+                    preconnect.close()
+                if dest_s is not None:
+                    dest_s.close()
+                conn.close()
+        # The relay blocks in select() instead.
+        conn.settimeout(None)
+        dest_s.settimeout(None)
+
+        # Both the relayed frames and the packets injected by the plugins go
+        # through the queues, flushed once per batch of frames.
+        queues = {"C": SendQueue(conn), "S": SendQueue(dest_s)}
+        session = self.newSession(queues["C"], firstmsg_contents,
+                                  queues["S"])
+        session['conn'] = conn
+        session['dest_s'] = dest_s
+        session['readers'] = {"C": client_reader, "S": server_reader}
+        session['queues'] = queues
+        if self.plugin_executor is not None:
+            # The outcome of the hooks that ran on other threads is handed
+            # back to the relay through these.
+            session['posted'] = collections.deque()
+            session['wakeup'] = socket.socketpair()
+            session['wakeup'][1].setblocking(False)
+            session['post'] = lambda func, *args: self.postToRelay(
+                session, func, args)
+        # Without plugins, both directions are relayed by the kernel, along
+        # with whatever already got buffered.
+        session['pumps'] = {"C": None, "S": None}
+        if self.isPassthrough():
+            session['pumps']["C"] = Passthrough(conn, dest_s)
+            dest_s.sendall(client_reader.takePending())
+            session['pumps']["S"] = Passthrough(dest_s, conn)
+            conn.sendall(server_reader.takePending())
+        return session
+
+    def runRelay(self, session):
+        """The second part of handleGame: relays the session and cleans up.
 
-        xtea_key = firstmsg_contents['xtea_key']
-        firstmsg_contents['timestamp'] = challenge_data['timestamp']
-        firstmsg_contents['random_number'] = challenge_data['random_number']
-        dest_s.send(GameProtocol.prepareReply(firstmsg_contents,
-                                              self.real_tibia))
-
-        conn_obj = Connection(conn, xtea_key)
-        received_player = False
-        while True:
-            # Wait until either the player or the server sent some data.
-            has_data, _, _ = select.select([conn, dest_s], [], [])
-            if conn in has_data:
-                data = bytearray()
-                size_raw = conn.recv(2)
-                data += size_raw
-                if size_raw == bytearray():
-                    log("The client disconnected")
-                    break
-                size = struct.unpack("<H", size_raw)[0]
-                data += conn.recv(size+4)
-                msg = NetworkMessage(data)
-                msg_size = msg.getU16()
-                msg.getU32()  # skip the checksum validation
-                if msg_size != len(data) - 2:
-                    log("Strange packet from client: %s" % repr(data))
-                    log("len(data)=%s, msg_size=%s" % (len(data), msg_size))
-                    dest_s.send(data)
-                    continue
-                msg_buf = XTEA.XTEA_decrypt(msg.getRest(), xtea_key)
-                msg = NetworkMessage(msg_buf)
-                msg.getU16()
-                packet_type = msg.getByte()
-                if packet_type in GameProtocol.client_packet_types:
-                    if self.debug:
-                        log("C [%s] %s" % (hex(packet_type),
-                            GameProtocol.client_packet_types[packet_type]))
+        Args:
+            session (dict): as returned by gameHandshake
+
+        Returns None
+        """
+        try:
+            self.relayGame(session)
+        finally:
+            self.closeSession(session)
+
+    def closeSession(self, session):
+        """Closes both connections of a game session.
+
+        Args:
+            session (dict): as returned by gameHandshake
+
+        Returns None
+        """
+        for pump in session['pumps'].values():
+            if pump is not None:
+                pump.close()
+        session['conn'].close()
+        session['dest_s'].close()
+        for sock in session.get('wakeup') or []:
+            sock.close()
+
+    def relayGame(self, session):
+        """Relays the frames of a game session until either side disconnects.
+
+        Args:
+            session (dict): as returned by newSession, along with the
+                player's connection ('conn'), the game server's connection
+                ('dest_s') and the 'readers' (FrameReader), 'queues'
+                (SendQueue) and 'pumps' (Passthrough or None) of both
+                directions
+
+        Returns None
+        """
+        conn = session['conn']
+        dest_s = session['dest_s']
+        readers = session['readers']
+        sockets = [conn, dest_s]
+        wakeup = session.get('wakeup')
+        if wakeup is not None:
+            sockets += [wakeup[0]]
+        # Not select(), which cannot wait for the descriptors numbered above
+        # 1023, and with a thousand sessions relayed, most of them are.
+        with selectors.DefaultSelector() as selector:
+            for sock in sockets:
+                selector.register(sock, selectors.EVENT_READ)
+            while True:
+                # Wait until either the player or the server sent some data,
+                # unless whole frames that came along with the handshake are
+                # still waiting in the buffers.
+                if readers["C"].hasFrame() or readers["S"].hasFrame():
+                    timeout = 0
                 else:
-                    log("Got a packet of type %s from client" % packet_type)
-                should_forward = True
-                if packet_type == 150:
-                    # We got a player "say" request. Read what the player
-                    # wanted to say, treat it like a Python expression and send
-                    # the result back to the user.
-                    msg.skipBytes(1)
-                    player_said = msg.getString()
-                    for plugin in self.plugins:
-                        if 'on_client_say' in dir(plugin):
-                            plugin_returned = plugin.on_client_say(conn_obj,
-                                                                   player_said)
-
-                            if plugin_returned:
-                                should_forward = False
-
-                if should_forward:
-                    # Otherwise, just pass the packet to the server.
-                    dest_s.send(data)
-            if dest_s in has_data:
-                # Server sent us some data.
-                data = bytearray()
-                size_raw = dest_s.recv(2)
-                data += size_raw
-                if data == bytearray():
+                    timeout = None
+                has_data = [key.fileobj for key, _ in
+                            selector.select(timeout)]
+                if not self.relayFrames(session, "C", conn in has_data):
+                    log("The client disconnected")
+                    return
+                if not self.relayFrames(session, "S", dest_s in has_data):
                     conn.close()
                     log("The server disconnected")
-                    break
-                size = struct.unpack("<H", size_raw)[0]
-                data += dest_s.recv(size)
-                msg = NetworkMessage(data)
-                msg_size = msg.getU16()
-                msg.getU32()  # skip the checksum validation
-                if msg_size != len(data) - 2:
-                    log("Strange packet from server: %s" % repr(data))
-                    log("len(data)=%s, msg_size=%s" % (len(data), msg_size))
-                    conn.send(data)
-                    continue
-                msg_buf = XTEA.XTEA_decrypt(msg.getRest(), xtea_key)
-                msg = NetworkMessage(msg_buf)
-                msg.getU16()
-                while msg.finished():
-                    def getMapDescription():
-                        def getTile():
-                            got_effect = False
-                            for stackPos in range(256):
-                                if msg.peekU16() >= 0xff00:
-                                    return msg.getU16() & 0xff
-                                if not got_effect:
-                                    msg.getU16()
-                                    got_effect = True
-                                    continue
-                                assert(stackPos <= 10)
-                                thingId = msg.getU16()
-                                log(thingId)
-                                assert(thingId != 0)
-                                if thingId == 96:
-                                    log("strange... got a staticText")
-                                elif thingId in [97, 98, 99]:
-                                    # it's a creature
-                                    pass
-                                else:
-                                    # it's a thing - might require reading 3
-                                    # extra bytes
-                                    pass
-
-                        def getFloorDescription(x, y, z, w, h, offset, skip):
-                            for nx in range(w):
-                                for ny in range(h):
-                                    getTile()
-
-                        x, y, z = msg.getCoordinates()
-                        w = 18
-                        h = 14
-                        skip = [-1]
-                        if z > 7:
-                            startz = z - 2
-                            endz = min(16 - 1, z + 2)
-                            zstep = 1
-                        else:
-                            startz = 7
-                            endz = 0
-                            zstep = -1
-                        nz = startz
-                        while nz != endz + zstep:
-                            getFloorDescription(x, y, nz, w, h, z - nz, skip)
-                            nz += zstep
-                    packet_type = msg.getByte()
-                    if packet_type in GameProtocol.server_packet_types:
-                        if self.debug:
-                            log("S [%s] %s" % (hex(packet_type),
-                                GameProtocol.server_packet_types[packet_type])
-                                )
-                    else:
-                        log("Got a packet of type %s from server" %
-                            packet_type)
-                    # login successful
-                    if packet_type == 0x17:
-                        msg.getU32()   # player ID
-                        msg.getU16()   # beat duration
-                        msg.getU32()   # speed A
-                        msg.getU32()   # speed B
-                        msg.getU32()   # speed C
-                        msg.getByte()  # 1 if can report bugs, 0 otherwise
-
-                        # no idea what's this:
-                        assert_equal(msg.getByte(), 0xB6)
-                        assert_equal(msg.getByte(), 0x7F)
-                        assert_equal(msg.getByte(), 0x00)
-                        assert_equal(msg.getByte(), 0x0A)
-                        assert_equal(msg.getByte(), 0x0F)
-                        assert_equal(msg.getByte(), 0x64)
-                        getMapDescription()
-                        log("TODO")
-                        received_player = True
-                    # FYI box
-                    if packet_type == 0x15:
-                        fyi = msg.getString()
-                        log("Got a FYI: %s" % fyi)
-
-                log("Sending!")
-
-                conn.send(data)
+                    return
+                if wakeup is not None and wakeup[0] in has_data:
+                    self.runPosted(session)
+
+    def postToRelay(self, session, func, args):
+        """Has the relay thread of a session call func(*args). May be called
+        from any thread.
+
+        Returns None
+        """
+        session['posted'].append((func, args))
+        try:
+            session['wakeup'][1].send(b'\0')
+        except socket.error:
+            # Either the relay has plenty of wakeups pending already, or the
+            # session is gone.
+            pass
+
+    def runPosted(self, session):
+        """Calls what was posted to the relay thread of a session.
+
+        Returns None
+        """
+        session['wakeup'][0].recv(4096)
+        posted = session['posted']
+        while posted:
+            func, args = posted.popleft()
+            func(*args)
+        session['queues']["S"].flush()
+        session['queues']["C"].flush()
+
+    def relayFrames(self, session, direction, readable):
+        """Relays whatever one side of a game session has sent.
+
+        Args:
+            session (dict): see relayGame
+            direction (str): "C" for the client's side, "S" for the server's
+            readable (bool): whether select() found the side's socket
+                readable
+
+        Returns bool (False if the side disconnected)
+        """
+        pump = session['pumps'][direction]
+        if pump is not None:
+            return not readable or pump.pump() > 0
+        reader = session['readers'][direction]
+        if not readable and not reader.hasFrame():
+            return True
+        frames = reader.readFrames()
+        if frames is None:
+            return False
+        queues = session['queues']
+        other = "S" if direction == "C" else "C"
+        for data in frames:
+            if self.filterFrame(session, direction, data):
+                queues[other].send(data)
+        # The packets the plugins injected go right behind the frames.
+        session['connection'].flush()
+        # The frames are only valid until the next read.
+        queues["S"].flush()
+        queues["C"].flush()
+        return True
+
+    def isPassthrough(self):
+        """Returns bool (whether the sessions can be relayed without even
+        splitting them into frames: no plugin subscribed and no debug
+        logging). It is all or nothing: a plugin subscribed to either
+        direction may inject packets into both, which only the framed relay
+        can interleave with the relayed frames)"""
+        return not self.debug and not self.registry.subscribed("C") and \
+            not self.registry.subscribed("S")
+
+    def gameServerAddress(self, firstmsg_contents):
+        """Looks up the game server of the character the player logs in with.
+
+        Args:
+            firstmsg_contents (dict): as returned by parseFirstMessage
+
+        Returns tuple (host, port) or None if the proxy did not see the
+            character log in, or forgot about it
+        """
+        name = firstmsg_contents['character_name']
+        address = self.routes.lookup(name)
+        if address is None:
+            log("Unknown character %s, disconnecting" % name)
+        return address
+
+    def answerChallenge(self, firstmsg_contents, msg):
+        """Builds the player's first message for the real game server, which
+        has to carry the challenge the server sent.
+
+        Args:
+            firstmsg_contents (dict): as returned by parseFirstMessage
+            msg (NetworkMessage): the server's challenge, without the size and
+                checksum
+
+        Returns bytearray
+        """
+        challenge_data = GameProtocol.parseChallengeMessage(msg)
+        firstmsg_contents['timestamp'] = challenge_data['timestamp']
+        firstmsg_contents['random_number'] = challenge_data['random_number']
+        return GameProtocol.prepareReply(firstmsg_contents, self.real_tibia,
+                                         self.handshake)
+
+    def newSession(self, conn, firstmsg_contents, server_conn, post=None):
+        """Sets up the per-session state of the relay.
+
+        Args:
+            conn (object): the client's connection; anything with a send
+                method
+            firstmsg_contents (dict): as returned by parseFirstMessage
+            server_conn (object): the game server's connection, the same
+            post (function): post(func, *args) has the relay call func(*args)
+                soon; called by other threads. Needed with plugin threads.
+
+        Returns dict
+        """
+        # The key stays the same for the whole session, so its round
+        # constants are computed just once.
+        cipher = XTEA.XTEACipher(firstmsg_contents['xtea_key'])
+        return {'connection': Connection(conn, cipher, server_conn),
+                'C': FrameCodec(cipher, self.verify_checksums),
+                'S': FrameCodec(cipher, self.verify_checksums),
+                'pool': MessagePool(),
+                'post': post}
+
+    def filterFrame(self, session, direction, data):
+        """Decides what to do with a relayed frame, passing the packets in it
+        to the plugins subscribed to them.
+
+        Args:
+            session (dict): as returned by newSession
+            direction (str): "C" for the client's frames, "S" for the
+                server's
+            data (bytearray): the whole frame; it is left intact
+
+        Returns bool (True if the frame should be forwarded)
+        """
+        size = struct.unpack_from("<H", data)[0]
+        source = "client" if direction == "C" else "server"
+        if size != len(data) - 2:
+            log("Strange packet from %s: %s" % (source, repr(bytes(data))))
+            log("len(data)=%s, msg_size=%s" % (len(data), size))
+            return True
+        # Only the frames somebody is interested in get decrypted, and only
+        # the subscribed packets get parsed; in the debug mode, everything is
+        # parsed so that it can be logged.
+        if not self.debug and not self.registry.subscribed(direction):
+            return True
+        # Decrypted into the codec's own buffer; data stays intact for
+        # forwarding.
+        decoded = session[direction].decode(data)
+        if decoded is None:
+            log("Dropping a corrupt frame from %s" % source)
+            return False
+        pool = session['pool']
+        msg = pool.wrap(decoded)
+        if direction == "C":
+            parsers = GameProtocol.client_packet_parsers
+            skippers = GameProtocol.client_packet_skippers
+            names = GameProtocol.client_packet_types
+        else:
+            parsers = GameProtocol.server_packet_parsers
+            skippers = GameProtocol.server_packet_skippers
+            names = GameProtocol.server_packet_types
+        wanted = None if self.debug else self.wanted[direction]
+        should_forward = True
+        deferred = []
+        for packet_type, packet in GameProtocol.iterPackets(
+                msg, parsers, wanted, skippers):
+            self.logPacket(direction, packet_type, names)
+            if packet is None:
+                continue
+            # FYI box
+            if direction == "S" and packet_type == 0x15:
+                log("Got a FYI: %s" % packet['message'])
+            # Let the plugins decide what to do with the packet.
+            if self.plugin_executor is not None:
+                if self.registry.table[direction][packet_type]:
+                    deferred += [(packet_type, packet)]
+            elif self.registry.dispatch(direction, session['connection'],
+                                        packet_type, packet):
+                should_forward = False
+        pool.release(msg)
+        if deferred:
+            self.deferFrame(session, direction, data, deferred)
+            return False
+        return should_forward
+
+    def deferFrame(self, session, direction, data, packets):
+        """Passes the packets of a frame to the plugins on the plugin
+        threads, meanwhile holding the frame back. The relay then forwards
+        it, unless a hook asked to drop it, once the hooks are done or out of
+        time; the frames that came after it are not held up.
+
+        Args:
+            session (dict): as returned by newSession
+            direction (str): "C" for the client's frames, "S" for the
+                server's
+            data (bytearray): the whole frame
+            packets (list): (opcode, packet) tuples for the plugins
+
+        Returns None
+        """
+        frame = bytes(data)
+        connection = session['connection']
+
+        def runHooks():
+            drop = False
+            for packet_type, packet in packets:
+                if self.registry.dispatch(direction, connection, packet_type,
+                                          packet):
+                    drop = True
+            return drop
+
+        def finish(drop):
+            if not drop:
+                connection.forward(direction, frame)
+            connection.flush()
+
+        self.plugin_executor.submit(
+            runHooks, lambda drop: session['post'](finish, drop))
+
+    def logPacket(self, direction, packet_type, names):
+        """Logs the type of a relayed packet: always if it is unknown,
+        otherwise only in the debug mode.
+
+        Args:
+            direction (str): "C" for the client's packets, "S" for the
+                server's
+            packet_type (int): the packet's opcode
+            names (dict): client_packet_types or server_packet_types
+
+        Returns None
+        """
+        if packet_type not in names:
+            log("Got a packet of type %s from %s" % (
+                packet_type, "client" if direction == "C" else "server"))
+        elif self.debug:
+            log("%s [%s] %s" % (direction, hex(packet_type),
+                                names[packet_type]))
 
     def serveLogin(self, one_shot=False):
         """Listen for login server connections and handle them.
@@ -358,15 +797,17 @@ class Server:
         Returns None
         """
         def accept_login_conn():
-            conn, addr = self.l_s.accept()
+            try:
+                conn, addr = self.l_s.accept()
+            except socket.error as e:
+                self.acceptFailed(e)
+                return
             log("Received a login connection from %s:%s" % addr)
-            data = conn.recv(1024)
-            msg = NetworkMessage(data)
             if not self.debug:
-                t = threading.Thread(target=self.handleLogin, args=[conn, msg])
-                t.start()
+                self.scheduler.handshake(self.serveLoginConnection, [conn],
+                                         lambda: self.reject(conn, addr))
             else:
-                self.handleLogin(conn, msg)
+                self.serveLoginConnection(conn)
 
         if one_shot:
             accept_login_conn()
@@ -375,17 +816,41 @@ class Server:
             while True:
                 accept_login_conn()
 
+    def serveLoginConnection(self, conn):
+        """Reads the login request of an accepted connection and handles it.
+
+        Args:
+            conn (socket): the player's connection
+
+        Returns None
+        """
+        # A client that stalls only holds the handshake for so long.
+        conn.settimeout(self.handshake_timeout)
+        try:
+            data = FrameReader(conn).readFrame()
+            if data is None:
+                conn.close()
+                return
+            self.handleLogin(conn, NetworkMessage(data))
+        except socket.error as e:
+            log("The login handshake failed: %s" % e)
+            conn.close()
+
     def serveGame(self, one_shot=False):
         """Listen for game server connections and handle them.
 
         Returns None
         """
         def accept_game_conn():
-            conn, addr = self.g_s.accept()
+            try:
+                conn, addr = self.g_s.accept()
+            except socket.error as e:
+                self.acceptFailed(e)
+                return
             log("Received a game server connection from %s:%s" % addr)
             if not self.debug:
-                t = threading.Thread(target=self.handleGame, args=[conn])
-                t.start()
+                self.scheduler.handshake(self.serveGameConnection, [conn],
+                                         lambda: self.reject(conn, addr))
             else:
                 self.handleGame(conn)
 
@@ -396,6 +861,43 @@ class Server:
             while True:
                 accept_game_conn()
 
+    def serveGameConnection(self, conn):
+        """Runs the game handshake of an accepted connection and schedules the
+        relay of the session.
+
+        Args:
+            conn (socket): the player's connection
+
+        Returns None
+        """
+        session = self.gameHandshake(conn)
+        if session is not None:
+            self.scheduler.relay(self.runRelay, [session],
+                                 lambda: self.closeSession(session))
+
+    # How long to wait after a failed accept(), in seconds. It mostly fails
+    # for the lack of file descriptors, which takes some sessions to end.
+    ACCEPT_BACKOFF = 0.1
+
+    def acceptFailed(self, e):
+        """Logs a failed accept() and waits a little before the next one.
+
+        Args:
+            e (socket.error): what accept() raised
+
+        Returns None
+        """
+        log("Could not accept a connection: %s" % e)
+        time.sleep(self.ACCEPT_BACKOFF)
+
+    def reject(self, conn, addr):
+        """Turns away a connection the proxy has no room for.
+
+        Returns None
+        """
+        log("Rejecting the connection from %s:%s" % addr)
+        conn.close()
+
     def run(self):
         """Run serveLogin and serveGame threads and sleep forever.
 
@@ -409,10 +911,15 @@ class Server:
                                               self.destination_login_host,
                                               self.destination_login_port))
 
-        self.l_s.listen(1)
-        self.g_s.listen(1)
+        self.l_s.listen(self.listen_backlog)
+        self.g_s.listen(self.listen_backlog)
+        self.upstreams.start()
 
         if not self.debug:
+            self.scheduler = ConnectionScheduler(self.handshake_threads,
+                                                 self.relay_threads,
+                                                 self.max_queued,
+                                                 self.max_queue_wait)
             t_l = threading.Thread(target=self.serveLogin)
             g_l = threading.Thread(target=self.serveGame)
 
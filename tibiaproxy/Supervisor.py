@@ -0,0 +1,105 @@
+"""
+Supervisor.py - runs the proxy in several worker processes sharing the same
+ports and restarts the ones that die.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import multiprocessing
+import multiprocessing.connection
+import sys
+import time
+
+from tibiaproxy.util import log
+
+# A worker that dies sooner than that after being started is restarted only
+# after the same delay, so that a broken setup does not fork in a loop.
+MIN_WORKER_LIFETIME = 1.0
+
+
+def _runWorker(server_class, server_args):
+    """The body of a worker process.
+
+    Returns None
+    """
+    server_class(**server_args).run()
+
+
+class Supervisor(object):
+    """Forks the worker processes, each of them running its own server on the
+    same ports thanks to SO_REUSEPORT, so that the kernel spreads the
+    connections between them and each has its own GIL. Since a player's login
+    and game connections may be accepted by different workers, the server
+    arguments should include routes shared between them, e.g. a RoutingTable
+    with an MmapBackend."""
+
+    def __init__(self, server_class, server_args, workers):
+        """Create a Supervisor instance.
+
+        Args:
+            server_class (class): Server or one of its subclasses
+            server_args (dict): the keyword arguments of server_class
+            workers (int): the number of worker processes
+        """
+        self.server_class = server_class
+        self.server_args = dict(server_args, reuse_port=True)
+        self.workers = workers
+        # The workers inherit the plugins and the shared routes, so they have
+        # to be forked.
+        self.context = multiprocessing.get_context('fork')
+        self.processes = []
+        self.started = []
+
+    def spawn(self):
+        """Starts a worker process.
+
+        Returns Process
+        """
+        process = self.context.Process(target=_runWorker,
+                                       args=(self.server_class,
+                                             self.server_args))
+        process.start()
+        return process
+
+    def run(self):
+        """Starts the workers and restarts them as they die, forever.
+
+        Returns None
+        """
+        log("Starting %s worker processes." % self.workers)
+        for _ in range(self.workers):
+            self.processes += [self.spawn()]
+            self.started += [time.time()]
+        try:
+            while True:
+                multiprocessing.connection.wait(
+                    [process.sentinel for process in self.processes])
+                for i, process in enumerate(self.processes):
+                    if process.is_alive():
+                        continue
+                    process.join()
+                    log("Worker %s died with exit code %s, restarting it." % (
+                        process.pid, process.exitcode))
+                    lifetime = time.time() - self.started[i]
+                    if lifetime < MIN_WORKER_LIFETIME:
+                        time.sleep(MIN_WORKER_LIFETIME - lifetime)
+                    self.processes[i] = self.spawn()
+                    self.started[i] = time.time()
+        except (KeyboardInterrupt, SystemExit):
+            for process in self.processes:
+                process.terminate()
+            sys.exit("Received keyboard interrupt, quitting")
@@ -0,0 +1,367 @@
+"""
+UpstreamGroup.py - spreads the logins between several login servers and
+keeps track of which of them are up.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import socket
+import threading
+import time
+
+from tibiaproxy.FrameReader import FrameReader
+from tibiaproxy.Preconnect import Preconnect
+from tibiaproxy.UpstreamPool import UpstreamPool
+from tibiaproxy.util import log
+
+# How much a new measurement weighs in the average reply time.
+LATENCY_SMOOTHING = 0.2
+
+
+class Upstream(object):
+    """A login server of the group, along with what is known about it."""
+
+    def __init__(self, address, weight=1, pool_size=0, pool_idle=10.0):
+        """Create an Upstream instance.
+
+        Args:
+            address (tuple): the host and port of the login server
+            weight (int): its share of the logins, relative to the others
+            pool_size (int): the number of connections to it kept open in
+                advance (see UpstreamPool)
+            pool_idle (float): how long a pooled connection may stay unused,
+                in seconds
+        """
+        self.address = address
+        self.weight = weight
+        # The logins in progress.
+        self.active = 0
+        # The failures in a row.
+        self.failures = 0
+        self.healthy = True
+        # The average time it takes to reply, in seconds.
+        self.latency = 0.0
+        self.pool = None
+        if pool_size > 0:
+            self.pool = UpstreamPool(address, pool_size, pool_idle)
+
+    def take(self):
+        """Takes an idle connection out of the pool.
+
+        Returns socket (connected and blocking) or None if there is no pool
+        or it is empty
+        """
+        if self.pool is None:
+            return None
+        return self.pool.get()
+
+    def __repr__(self):
+        return "%s:%s" % self.address
+
+
+class UpstreamGroup(object):
+    """The login servers the logins are forwarded to. Each login goes to the
+    healthy one with the fewest logins in progress for its weight, the
+    quickest one winning a tie. A login server is taken out of the rotation
+    once it failed max_failures logins in a row or the moment it does not
+    accept a probe connection; it is put back once a probe gets through.
+
+    >>> live = socket.socket()
+    >>> live.bind(('127.0.0.1', 0))
+    >>> live.listen(1)
+    >>> dead = socket.socket()
+    >>> dead.bind(('127.0.0.1', 0))
+    >>> group = UpstreamGroup([Upstream(dead.getsockname(), weight=2),
+    ...                        Upstream(live.getsockname())])
+    >>> group.acquire() is group.upstreams[0]
+    True
+    >>> group.probe()
+    >>> [upstream.healthy for upstream in group.upstreams]
+    [False, True]
+    >>> group.acquire() is group.upstreams[1]
+    True
+    """
+
+    def __init__(self, upstreams, probe_interval=5.0, timeout=3.0,
+                 max_failures=2):
+        """Create an UpstreamGroup instance.
+
+        Args:
+            upstreams (list): the Upstream instances
+            probe_interval (float): how often every login server gets a probe
+                connection, in seconds; 0 disables the probes
+            timeout (float): how long a login server may take to accept a
+                connection, and then to reply, before the login is retried
+                on another one, in seconds
+            max_failures (int): the failed logins in a row that take a login
+                server out of the rotation
+        """
+        self.upstreams = upstreams
+        self.probe_interval = probe_interval
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Starts filling the connection pools and probing the login servers
+        in the background. A lone login server is not probed, since the
+        logins have nowhere else to go anyway.
+
+        Returns None
+        """
+        for upstream in self.upstreams:
+            if upstream.pool is not None:
+                upstream.pool.start()
+        if self.probe_interval > 0 and len(self.upstreams) > 1:
+            t = threading.Thread(target=self.probeForever)
+            t.daemon = True
+            t.start()
+
+    def acquire(self, exclude=()):
+        """Picks the login server for a login and counts the login in. If
+        none of them is healthy, the unhealthy ones are tried anyway.
+
+        Args:
+            exclude (list): the login servers that already failed this login
+
+        Returns Upstream or None if all of them are excluded
+        """
+        with self.lock:
+            candidates = [upstream for upstream in self.upstreams
+                          if upstream not in exclude]
+            if not candidates:
+                return None
+            healthy = [upstream for upstream in candidates
+                       if upstream.healthy]
+            upstream = min(healthy or candidates, key=lambda upstream: (
+                (upstream.active + 1) / float(upstream.weight),
+                upstream.latency))
+            upstream.active += 1
+            return upstream
+
+    def release(self, upstream, ok=None, elapsed=None):
+        """Counts a login out, recording how the login server did.
+
+        Args:
+            upstream (Upstream): the login server acquire() returned
+            ok (bool): whether it replied; None if the login was abandoned
+                for some other reason
+            elapsed (float): how long it took to reply, in seconds
+
+        Returns None
+        """
+        with self.lock:
+            upstream.active -= 1
+            if ok:
+                upstream.failures = 0
+                if elapsed is not None:
+                    upstream.latency += LATENCY_SMOOTHING * (
+                        elapsed - upstream.latency)
+                self.markHealthy(upstream)
+            elif ok is not None:
+                upstream.failures += 1
+                if upstream.failures >= self.max_failures:
+                    self.markUnhealthy(upstream)
+
+    def markHealthy(self, upstream):
+        """Puts a login server back into the rotation. Expects the lock to
+        be held.
+
+        Returns None
+        """
+        if not upstream.healthy:
+            log("Login server %s is back up." % upstream)
+            upstream.healthy = True
+            upstream.failures = 0
+
+    def markUnhealthy(self, upstream):
+        """Takes a login server out of the rotation. Expects the lock to be
+        held.
+
+        Returns None
+        """
+        if upstream.healthy:
+            log("Login server %s is down." % upstream)
+            upstream.healthy = False
+
+    def probe(self):
+        """Tries to connect to every login server once.
+
+        Returns None
+        """
+        for upstream in self.upstreams:
+            try:
+                socket.create_connection(upstream.address,
+                                         self.timeout).close()
+                up = True
+            except socket.error:
+                up = False
+            with self.lock:
+                if up:
+                    self.markHealthy(upstream)
+                else:
+                    self.markUnhealthy(upstream)
+
+    def probeForever(self):
+        """The body of the probing thread.
+
+        Returns None
+        """
+        while True:
+            self.probe()
+            time.sleep(self.probe_interval)
+
+
+class UpstreamRequest(object):
+    """A login request forwarded by a blocking server. The connection to the
+    first login server is started right away, so that it can be established
+    while the request is being prepared; send() then retries on the other
+    login servers until one of them replies.
+
+    >>> dead = socket.socket()
+    >>> dead.bind(('127.0.0.1', 0))
+    >>> live = socket.socket()
+    >>> live.bind(('127.0.0.1', 0))
+    >>> live.listen(1)
+    >>> def answer():
+    ...     s, _ = live.accept()
+    ...     s.recv(64)
+    ...     s.sendall(b'\\x02\\x00hi')
+    ...     s.close()
+    >>> threading.Thread(target=answer).start()
+    >>> group = UpstreamGroup([Upstream(dead.getsockname(), weight=2),
+    ...                        Upstream(live.getsockname())], max_failures=1)
+    >>> bytes(UpstreamRequest(group).send(b'\\x01\\x00x'))
+    b'\\x02\\x00hi'
+    >>> [upstream.healthy for upstream in group.upstreams]
+    [False, True]
+    """
+
+    def __init__(self, group):
+        """Create an UpstreamRequest instance, connecting to the first login
+        server.
+
+        Args:
+            group (UpstreamGroup): the login servers
+        """
+        self.group = group
+        self.tried = []
+        self.upstream = None
+        self.sock = None
+        self.preconnect = None
+        self.started = None
+        self.next()
+
+    def next(self):
+        """Moves on to the next login server, if there is one left.
+
+        Returns None
+        """
+        self.upstream = self.group.acquire(self.tried)
+        if self.upstream is None:
+            return
+        self.tried += [self.upstream]
+        self.started = time.time()
+        self.sock = self.upstream.take()
+        self.preconnect = None
+        if self.sock is None:
+            log("Connecting to the login server %s..." % self.upstream)
+            self.preconnect = Preconnect(self.upstream.address)
+
+    def exchange(self, request):
+        """Sends the request to the current login server and reads its
+        reply.
+
+        Returns memoryview or None if the login server failed
+        """
+        sock = self.sock
+        self.sock = None
+        if sock is None:
+            sock = self.preconnect.take(self.upstream.address,
+                                        self.group.timeout)
+            if sock is None:
+                log("Could not connect to the login server %s." %
+                    self.upstream)
+                return None
+        try:
+            sock.settimeout(self.group.timeout)
+            sock.sendall(request)
+            data = FrameReader(sock).readFrame()
+            if data is None:
+                log("Login server %s disconnected." % self.upstream)
+            return data
+        except socket.error as e:
+            log("Login server %s failed: %s" % (self.upstream, e))
+            return None
+        finally:
+            sock.close()
+
+    def send(self, request):
+        """Forwards the request to the login servers, one after another,
+        until one of them replies.
+
+        Args:
+            request (bytearray): the login request
+
+        Returns memoryview or None if none of them replied
+        """
+        while self.upstream is not None:
+            data = self.exchange(request)
+            self.group.release(self.upstream, data is not None,
+                               time.time() - self.started)
+            if data is not None:
+                return data
+            self.next()
+        return None
+
+    def cancel(self):
+        """Gives up on the request before it was sent.
+
+        Returns None
+        """
+        if self.upstream is not None:
+            self.group.release(self.upstream)
+            self.upstream = None
+        if self.sock is not None:
+            self.sock.close()
+        if self.preconnect is not None:
+            self.preconnect.close()
+
+
+def openUpstreamGroup(upstreams, probe_interval=5.0, timeout=3.0,
+                      max_failures=2, pool_size=0, pool_idle=10.0):
+    """Creates the group of login servers described by the configuration.
+
+    Args:
+        upstreams (list): (host, port) or (host, port, weight) tuples
+        probe_interval (float): see UpstreamGroup
+        timeout (float): see UpstreamGroup
+        max_failures (int): see UpstreamGroup
+        pool_size (int): the connections kept open to each login server
+        pool_idle (float): see UpstreamPool
+
+    Returns UpstreamGroup
+    """
+    return UpstreamGroup([Upstream((entry[0], int(entry[1])),
+                                   entry[2] if len(entry) > 2 else 1,
+                                   pool_size, pool_idle)
+                          for entry in upstreams],
+                         probe_interval, timeout, max_failures)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
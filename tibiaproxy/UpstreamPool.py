@@ -0,0 +1,170 @@
+"""
+UpstreamPool.py - keeps a few connections to the login server open in
+advance, so that a login does not have to wait for one to be established.
+"""
+
+#This file is part of tibiaproxy.
+#
+#tibiaproxy is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#Joggertester is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Foobar; if not, write to the Free Software
+#Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import collections
+import selectors
+import socket
+import threading
+import time
+
+from tibiaproxy.util import log
+
+
+def is_healthy(sock):
+    """Tells whether an idle connection is still usable. The login server
+    never speaks first, so an idle connection that became readable was
+    either closed by the server or is out of sync.
+
+    Returns bool
+    """
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(sock, selectors.EVENT_READ)
+            readable = selector.select(0)
+    except (ValueError, KeyError, socket.error):
+        return False
+    return not readable
+
+
+class UpstreamPool(object):
+    """Up to size idle connections to one upstream server, kept open by a
+    background thread that replaces the ones that were taken, closed by the
+    server or idle for longer than max_idle seconds.
+
+    >>> listener = socket.socket()
+    >>> listener.bind(('127.0.0.1', 0))
+    >>> listener.listen(4)
+    >>> pool = UpstreamPool(listener.getsockname(), size=2)
+    >>> pool.fill()
+    >>> len(pool.idle)
+    2
+    >>> pool.get().getpeername() == listener.getsockname()
+    True
+    >>> len(pool.idle)
+    1
+    >>> pool.close()
+    """
+
+    def __init__(self, address, size=4, max_idle=10.0, check_interval=1.0,
+                 connect_timeout=5.0):
+        """Create an UpstreamPool instance. The pool starts empty; call
+        start() to have it filled in the background.
+
+        Args:
+            address (tuple): the host and port of the upstream server
+            size (int): the number of idle connections to keep
+            max_idle (float): how long a connection may stay unused, in
+                seconds; servers tend to drop silent clients
+            check_interval (float): how often the idle connections are
+                checked, in seconds
+            connect_timeout (float): the connect() timeout, in seconds
+        """
+        self.address = address
+        self.size = size
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self.connect_timeout = connect_timeout
+        # (socket, the time it was connected), the newest on the right.
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+
+    def start(self):
+        """Starts the background thread that keeps the pool full.
+
+        Returns None
+        """
+        t = threading.Thread(target=self.maintain)
+        t.daemon = True
+        t.start()
+
+    def get(self):
+        """Takes an idle connection out of the pool and has it replaced.
+
+        Returns socket or None if the pool has no usable connection
+        """
+        self.wakeup.set()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    return None
+                # The oldest first, as it is the closest to being dropped.
+                sock, _ = self.idle.popleft()
+            if is_healthy(sock):
+                return sock
+            sock.close()
+
+    def maintain(self):
+        """The body of the background thread.
+
+        Returns None
+        """
+        while not self.closed:
+            try:
+                self.fill()
+            except socket.error as e:
+                log("Could not connect to the upstream %s:%s: %s" % (
+                    self.address[0], self.address[1], e))
+            self.wakeup.wait(self.check_interval)
+            self.wakeup.clear()
+
+    def fill(self):
+        """Drops the stale and broken idle connections and opens new ones
+        until there are size of them.
+
+        Returns None
+        """
+        now = time.time()
+        with self.lock:
+            idle = list(self.idle)
+            self.idle.clear()
+        kept = []
+        for sock, since in idle:
+            if now - since < self.max_idle and is_healthy(sock):
+                kept += [(sock, since)]
+            else:
+                sock.close()
+        with self.lock:
+            self.idle.extendleft(reversed(kept))
+            missing = self.size - len(self.idle)
+        for _ in range(missing):
+            sock = socket.create_connection(self.address,
+                                            self.connect_timeout)
+            sock.settimeout(None)
+            with self.lock:
+                self.idle.append((sock, time.time()))
+
+    def close(self):
+        """Stops the background thread and closes the idle connections.
+
+        Returns None
+        """
+        self.closed = True
+        self.wakeup.set()
+        with self.lock:
+            for sock, _ in self.idle:
+                sock.close()
+            self.idle.clear()
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
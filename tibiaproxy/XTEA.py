@@ -20,19 +20,20 @@ XTEA encryption/decryption module.
 
 import struct
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def XTEA_encrypt(buf, k):
-    """Encrypts a given message using the given key.
+DELTA = 0x9E3779B9
 
-    >>> key = [4060739823, 3225438839, 2808461571, 1241583342]
-    >>> encrypted = b\'\\xfc\\xd9\\xd8A\\x0b\\xc4~\\x82\'
-    >>> decrypted = b\'I\\x00\\x14"\\x001\\nW\'
-    >>> XTEA_encrypt(decrypted, key) == encrypted
-    True
+# Below this number of 8-byte blocks the per-call overhead of NumPy outweighs
+# the gain of processing the blocks as lanes, so the pure-Python code is used.
+NUMPY_MIN_BLOCKS = 16
 
-    Args:
-        buf (str): the data to be encrypted
-        k (list): XTEA key - a list of four OpenTibia U32 integers
+
+def _py_encrypt(buf, k):
+    """Pure-Python XTEA encryption of every full 8-byte block of buf.
 
     Returns bytearray
     """
@@ -40,7 +41,6 @@ def XTEA_encrypt(buf, k):
     for offset in range(int(len(buf)/8)):
         v0 = struct.unpack("<I", bytes(buf[offset*8:offset*8+4]))[0]
         v1 = struct.unpack("<I", bytes(buf[offset*8+4:offset*8+8]))[0]
-        delta = 0x9E3779B9
         sum_ = 0
 
         for _ in range(32):
@@ -48,7 +48,7 @@ def XTEA_encrypt(buf, k):
             v0 += ((v1 << 4 ^ v1 >> 5) + v1) ^ (sum_ + k[sum_ & 3])
             v0 &= 0xFFFFFFFF
 
-            sum_ = (sum_ + delta) & 0xFFFFFFFF
+            sum_ = (sum_ + DELTA) & 0xFFFFFFFF
 
             v1 += ((v0 << 4 ^ v0 >> 5) + v0) ^ (sum_ + k[sum_ >> 11 & 3])
             v1 &= 0xFFFFFFFF
@@ -57,6 +57,124 @@ def XTEA_encrypt(buf, k):
     return ret
 
 
+def _py_decrypt(buf, k):
+    """Pure-Python XTEA decryption of every full 8-byte block of buf.
+
+    Returns bytearray
+    """
+    ret = bytearray()
+    for offset in range(int(len(buf)/8)):
+        v0 = struct.unpack("<I", bytes(buf[offset*8:offset*8+4]))[0]
+        v1 = struct.unpack("<I", bytes(buf[offset*8+4:offset*8+8]))[0]
+        sum_ = 0xC6EF3720
+
+        for _ in range(32):
+
+            v1 -= ((v0 << 4 ^ v0 >> 5) + v0) ^ (sum_ + k[sum_ >> 11 & 3])
+            v1 &= 0xFFFFFFFF
+
+            sum_ = (sum_ - DELTA) & 0xFFFFFFFF
+
+            v0 -= ((v1 << 4 ^ v1 >> 5) + v1) ^ (sum_ + k[sum_ & 3])
+            v0 &= 0xFFFFFFFF
+
+        ret += struct.pack("<I", v0) + struct.pack("<I", v1)
+    return ret
+
+
+def _numpy_lanes(buf):
+    """Splits every full 8-byte block of buf into two uint32 lane arrays.
+
+    Returns tuple
+    """
+    size = len(buf) - len(buf) % 8
+    lanes = numpy.frombuffer(bytes(buf[:size]), dtype='<u4').reshape(-1, 2)
+    return lanes[:, 0].astype(numpy.uint32), lanes[:, 1].astype(numpy.uint32)
+
+
+def _numpy_join(v0, v1):
+    """Interleaves the two lane arrays back into little-endian bytes.
+
+    Returns bytearray
+    """
+    out = numpy.empty((len(v0), 2), dtype='<u4')
+    out[:, 0] = v0
+    out[:, 1] = v1
+    return bytearray(out.tobytes())
+
+
+def _numpy_encrypt(buf, k):
+    """XTEA encryption of all the blocks of buf at once, as NumPy lanes.
+
+    Returns bytearray
+    """
+    v0, v1 = _numpy_lanes(buf)
+    sum_ = 0
+    for _ in range(32):
+        t = v1 << 4
+        t ^= v1 >> 5
+        t += v1
+        t ^= numpy.uint32((sum_ + k[sum_ & 3]) & 0xFFFFFFFF)
+        v0 += t
+
+        sum_ = (sum_ + DELTA) & 0xFFFFFFFF
+
+        t = v0 << 4
+        t ^= v0 >> 5
+        t += v0
+        t ^= numpy.uint32((sum_ + k[sum_ >> 11 & 3]) & 0xFFFFFFFF)
+        v1 += t
+    return _numpy_join(v0, v1)
+
+
+def _numpy_decrypt(buf, k):
+    """XTEA decryption of all the blocks of buf at once, as NumPy lanes.
+
+    Returns bytearray
+    """
+    v0, v1 = _numpy_lanes(buf)
+    sum_ = 0xC6EF3720
+    for _ in range(32):
+        t = v0 << 4
+        t ^= v0 >> 5
+        t += v0
+        t ^= numpy.uint32((sum_ + k[sum_ >> 11 & 3]) & 0xFFFFFFFF)
+        v1 -= t
+
+        sum_ = (sum_ - DELTA) & 0xFFFFFFFF
+
+        t = v1 << 4
+        t ^= v1 >> 5
+        t += v1
+        t ^= numpy.uint32((sum_ + k[sum_ & 3]) & 0xFFFFFFFF)
+        v0 -= t
+    return _numpy_join(v0, v1)
+
+
+def _use_numpy(buf):
+    return numpy is not None and len(buf) >= NUMPY_MIN_BLOCKS * 8
+
+
+def XTEA_encrypt(buf, k):
+    """Encrypts a given message using the given key.
+
+    >>> key = [4060739823, 3225438839, 2808461571, 1241583342]
+    >>> encrypted = b\'\\xfc\\xd9\\xd8A\\x0b\\xc4~\\x82\'
+    >>> decrypted = b\'I\\x00\\x14"\\x001\\nW\'
+    >>> XTEA_encrypt(decrypted, key) == encrypted
+    True
+
+    Args:
+        buf (str): the data to be encrypted
+        k (list): XTEA key - a list of four OpenTibia U32 integers
+
+    Returns bytearray
+    """
+    if _use_numpy(buf):
+        return _numpy_encrypt(buf, k)
+    return _py_encrypt(buf, k)
+
+
 def XTEA_decrypt(buf, k):
     """Decrypts a given message using the given key.
 
@@ -72,25 +190,189 @@ def XTEA_decrypt(buf, k):
 
     Returns bytearray
     """
-    ret = bytearray()
-    for offset in range(int(len(buf)/8)):
-        v0 = struct.unpack("<I", bytes(buf[offset*8:offset*8+4]))[0]
-        v1 = struct.unpack("<I", bytes(buf[offset*8+4:offset*8+8]))[0]
-        delta = 0x9E3779B9
-        sum_ = 0xC6EF3720
+    if _use_numpy(buf):
+        return _numpy_decrypt(buf, k)
+    return _py_decrypt(buf, k)
+
+
+_BLOCK = struct.Struct("<2I")
+
+
+class XTEACipher(object):
+    """An XTEA cipher bound to a single key. The 64 round constants (the
+    "sum + k[...]" terms) only depend on the key, so they are computed once
+    when the cipher is created instead of for every block of every packet.
 
+    >>> key = [4060739823, 3225438839, 2808461571, 1241583342]
+    >>> cipher = XTEACipher(key)
+    >>> buf = bytearray(b\'I\\x00\\x14"\\x001\\nW\')
+    >>> cipher.encrypt_into(buf, buf)
+    8
+    >>> buf == bytearray(b\'\\xfc\\xd9\\xd8A\\x0b\\xc4~\\x82\')
+    True
+    >>> out = bytearray(8)
+    >>> cipher.decrypt_into(buf, out)
+    8
+    >>> out == bytearray(b\'I\\x00\\x14"\\x001\\nW\')
+    True
+    >>> frame = bytearray(b\'\\x08\\x00\') + out
+    >>> cipher.encrypt_inplace(frame, 2)
+    8
+    >>> cipher.decrypt_inplace(memoryview(frame)[2:])
+    8
+    >>> frame[2:] == out
+    True
+    """
+
+    def __init__(self, k):
+        """Create an XTEACipher instance.
+
+        Args:
+            k (list): XTEA key - a list of four OpenTibia U32 integers
+        """
+        self.key = list(k)
+        constants = []
+        sum_ = 0
         for _ in range(32):
+            constants += [(sum_ + k[sum_ & 3]) & 0xFFFFFFFF]
+            sum_ = (sum_ + DELTA) & 0xFFFFFFFF
+            constants += [(sum_ + k[sum_ >> 11 & 3]) & 0xFFFFFFFF]
+        self.round_constants = tuple(constants)
+        self.encrypt_rounds = tuple(zip(constants[0::2], constants[1::2]))
+        self.decrypt_rounds = tuple(reversed(self.encrypt_rounds))
+        if numpy is not None:
+            self.numpy_constants = numpy.array(constants, dtype=numpy.uint32)
 
-            v1 -= ((v0 << 4 ^ v0 >> 5) + v0) ^ (sum_ + k[sum_ >> 11 & 3])
-            v1 &= 0xFFFFFFFF
+    def encrypt_into(self, src, dst):
+        """Encrypts every full 8-byte block of src, writing the result to the
+        same offsets of dst. dst may be the same buffer as src.
 
-            sum_ = (sum_ - delta) & 0xFFFFFFFF
+        Args:
+            src (bytearray): the data to be encrypted
+            dst (bytearray): a writable buffer at least as long as src
 
-            v0 -= ((v1 << 4 ^ v1 >> 5) + v1) ^ (sum_ + k[sum_ & 3])
-            v0 &= 0xFFFFFFFF
+        Returns int (the number of bytes written)
+        """
+        size = len(src) - len(src) % 8
+        if numpy is not None and size >= NUMPY_MIN_BLOCKS * 8:
+            self._numpy_into(src, dst, size, True)
+            return size
+        unpack_from = _BLOCK.unpack_from
+        pack_into = _BLOCK.pack_into
+        rounds = self.encrypt_rounds
+        for offset in range(0, size, 8):
+            v0, v1 = unpack_from(src, offset)
+            for c0, c1 in rounds:
+                v0 = (v0 + ((((v1 << 4) ^ (v1 >> 5)) + v1) ^ c0)) & 0xFFFFFFFF
+                v1 = (v1 + ((((v0 << 4) ^ (v0 >> 5)) + v0) ^ c1)) & 0xFFFFFFFF
+            pack_into(dst, offset, v0, v1)
+        return size
 
-        ret += struct.pack("<I", v0) + struct.pack("<I", v1)
-    return bytearray(ret)
+    def decrypt_into(self, src, dst):
+        """Decrypts every full 8-byte block of src, writing the result to the
+        same offsets of dst. dst may be the same buffer as src.
+
+        Args:
+            src (bytearray): the data to be decrypted
+            dst (bytearray): a writable buffer at least as long as src
+
+        Returns int (the number of bytes written)
+        """
+        size = len(src) - len(src) % 8
+        if numpy is not None and size >= NUMPY_MIN_BLOCKS * 8:
+            self._numpy_into(src, dst, size, False)
+            return size
+        unpack_from = _BLOCK.unpack_from
+        pack_into = _BLOCK.pack_into
+        rounds = self.decrypt_rounds
+        for offset in range(0, size, 8):
+            v0, v1 = unpack_from(src, offset)
+            for c0, c1 in rounds:
+                v1 = (v1 - ((((v0 << 4) ^ (v0 >> 5)) + v0) ^ c1)) & 0xFFFFFFFF
+                v0 = (v0 - ((((v1 << 4) ^ (v1 >> 5)) + v1) ^ c0)) & 0xFFFFFFFF
+            pack_into(dst, offset, v0, v1)
+        return size
+
+    def encrypt_inplace(self, buf, offset=0, size=None):
+        """Encrypts size bytes of buf starting at offset where they sit,
+        without allocating any new buffers.
+
+        Args:
+            buf (bytearray): a writable buffer, e.g. the receive buffer or a
+                memoryview of it
+            offset (int): where the data to be encrypted begins
+            size (int): how many bytes to encrypt; defaults to the rest of
+                the buffer. Only full 8-byte blocks are processed.
+
+        Returns int (the number of bytes encrypted)
+        """
+        view = _view(buf, offset, size)
+        return self.encrypt_into(view, view)
+
+    def decrypt_inplace(self, buf, offset=0, size=None):
+        """Decrypts size bytes of buf starting at offset where they sit,
+        without allocating any new buffers.
+
+        Args:
+            buf (bytearray): a writable buffer, e.g. the receive buffer or a
+                memoryview of it
+            offset (int): where the data to be decrypted begins
+            size (int): how many bytes to decrypt; defaults to the rest of
+                the buffer. Only full 8-byte blocks are processed.
+
+        Returns int (the number of bytes decrypted)
+        """
+        view = _view(buf, offset, size)
+        return self.decrypt_into(view, view)
+
+    def _numpy_into(self, src, dst, size, encrypt):
+        """NumPy lane variant of encrypt_into/decrypt_into. The lanes are
+        strided views straight into dst, so the result is written in place.
+
+        Returns None
+        """
+        if src is not dst:
+            dst[:size] = src[:size]
+        lanes = numpy.frombuffer(dst, dtype='<u4', count=size // 4)
+        lanes = lanes.reshape(-1, 2)
+        v0 = lanes[:, 0]
+        v1 = lanes[:, 1]
+        c = self.numpy_constants
+        if encrypt:
+            for i in range(0, 64, 2):
+                t = v1 << 4
+                t ^= v1 >> 5
+                t += v1
+                t ^= c[i]
+                v0 += t
+                t = v0 << 4
+                t ^= v0 >> 5
+                t += v0
+                t ^= c[i + 1]
+                v1 += t
+        else:
+            for i in range(62, -1, -2):
+                t = v0 << 4
+                t ^= v0 >> 5
+                t += v0
+                t ^= c[i + 1]
+                v1 -= t
+                t = v1 << 4
+                t ^= v1 >> 5
+                t += v1
+                t ^= c[i]
+                v0 -= t
+
+
+def _view(buf, offset, size):
+    """Returns a zero-copy memoryview of buf[offset:offset+size].
+
+    Returns memoryview
+    """
+    view = memoryview(buf)
+    if size is None:
+        return view[offset:]
+    return view[offset:offset+size]
 
 if __name__ == "__main__":
     import sys